@@ -3,25 +3,55 @@
 
 import asyncio
 import logging
-import re
+import os
 import signal
 import time
-from functools import wraps
-from typing import Union, Callable, Optional, Match
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextvars import ContextVar
+from functools import partial, wraps
+from pathlib import Path
+from typing import (
+    Any,
+    Sequence,
+    Union,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Match,
+    Optional,
+    Tuple,
+    Type,
+)
 
+from attr import evolve
 from discord import (
+    AutoShardedClient,
     Client,
     Intents,
+    MemberCacheFlags,
     Message,
     Reaction,
     Member,
     User,
     DMChannel,
+    Guild,
     RawReactionActionEvent,
 )
+from discord.abc import GuildChannel, Messageable
 
+from legion import metrics
 from legion.config import Config
-from legion.unit import Unit, COMMANDS
+from legion.gateway import GatewayClient, GatewayServer
+from legion.matcher import command_matcher
+from legion.pools import WorkerPool
+from legion.ratelimit import RateLimiter, check_limits
+from legion.sharding import shard_label, shard_path
+from legion.state import StateStore
+from legion.unit import Command, Unit, COMMANDS, OVERFLOW
+from legion.units import import_unit
+from legion.view import CommandMatch, MessageView
 
 try:
     import uvloop
@@ -31,6 +61,31 @@ except ImportError:
 
 LOG = logging.getLogger(__name__)
 
+# reaction for commands rejected by rate limits
+THROTTLED = "⏳"
+
+# reaction for commands rejected by concurrency limits
+BUSY = "🚧"
+
+# tracked event task that the current code is running on behalf of, which
+# child tasks like the one wait_for() runs a command in inherit
+EVENT_TASK: ContextVar[Optional[asyncio.Future]] = ContextVar(
+    "event_task", default=None
+)
+
+# @command settings that can be overridden in config
+COMMAND_OVERRIDES = ("cost", "limits", "timeout", "max_concurrency", "overflow")
+
+# needed by the bot itself to see guilds and receive commands
+BOT_INTENTS = ("guilds", "guild_messages", "dm_messages")
+
+# intents that discord.py requires for each member cache flag
+MEMBER_CACHE_INTENTS = {
+    "joined": "members",
+    "online": "presences",
+    "voice": "voice_states",
+}
+
 
 def dispatch(fn):
     name = fn.__name__
@@ -39,14 +94,7 @@ def dispatch(fn):
     async def wrapped(self, *args, **kwargs):
         result = await fn(self, *args, **kwargs)
         if result is not False:
-            for unit in self.units.values():
-                method = getattr(unit, name, None)
-                if asyncio.iscoroutinefunction(method):
-                    try:
-                        LOG.debug(f"dispatch {name} to {method}")
-                        await method(*args, **kwargs)
-                    except Exception:
-                        LOG.exception(f"error from unit {unit}.{name}")
+            await self.dispatch_units(name, *args, **kwargs)
 
     return wrapped
 
@@ -54,12 +102,63 @@ def dispatch(fn):
 class Bot:
     loop: asyncio.AbstractEventLoop
 
-    def __init__(self, config: Config):
+    def __init__(
+        self, config: Config, worker: Optional[int] = None, args: Sequence[str] = ()
+    ):
         self.config = config
-        self.client = Client(intents=Intents.default())
-
-        unit_types = Unit.load()
-        self.units = {ut.__name__: ut(self, self.client) for ut in unit_types}
+        self.ready = False
+        self.stopping = False
+        self.limiter = RateLimiter()
+        self.command_overrides: Dict[str, Tuple[Command, Command]] = {}
+        self.command_slots: Dict[str, Tuple[int, asyncio.Semaphore]] = {}
+
+        # in-flight event handlers and other bot tasks, by description
+        self.tasks: Dict[asyncio.Future, str] = {}
+
+        # split mode, see legion.gateway
+        self.gateway: Optional[GatewayServer] = None
+        self.upstream: Optional[GatewayClient] = None
+        socket_path = self.shard_path(config.bot.socket_path)
+        if worker is not None:
+            self.upstream = GatewayClient(self, socket_path, worker)
+        elif config.bot.workers:
+            self.gateway = GatewayServer(self, socket_path, config.bot.workers, args)
+
+        # units known from the manifest but only imported on first use
+        self.unit_modules: Dict[str, str] = {}
+        self.subscribers: Dict[str, List[str]] = defaultdict(list)
+        self.unit_locks: Dict[str, asyncio.Lock] = {}
+
+        manifest = Unit.load_manifest() if config.bot.lazy_units else None
+        if manifest is None:
+            unit_types = Unit.load()
+            requirements = [ut.requirements() for ut in unit_types]
+            unit_types = [ut for ut in unit_types if self.runs_unit(ut.GATEWAY)]
+        else:
+            eager = []
+            requirements = []
+            for module, data in manifest["modules"].items():
+                for name, unit in data["units"].items():
+                    if not unit["enabled"]:
+                        continue
+                    requirements.append(unit)
+                    if not self.runs_unit(unit["gateway"]):
+                        continue
+                    self.unit_modules[name] = module
+                    for event in unit["events"]:
+                        self.subscribers[event].append(name)
+                    if self.starts_eagerly(unit):
+                        eager.append(name)
+            LOG.info(f"lazy loading units, eager units: {eager}")
+            unit_types = [self.unit_type(name) for name in eager]
+
+        # intents are fixed once connected, so lazy units count from the start
+        client_type = AutoShardedClient if config.discord.sharded else Client
+        self.client = client_type(**self.client_options(requirements))
+
+        self.units: Dict[str, Unit] = {
+            ut.__name__: ut(self, self.client) for ut in unit_types
+        }
 
         if uvloop and config.bot.uvloop:
             LOG.info("enabling uvloop")
@@ -69,6 +168,90 @@ class Bot:
         if config.bot.debug:
             self.loop.set_debug(True)
 
+        self.state = StateStore(config.bot.state_path, config.bot.state_flush_interval)
+
+        cpus = os.cpu_count() or 1
+        threads = config.bot.thread_workers or cpus
+        processes = config.bot.process_workers or cpus
+        self.threads = WorkerPool(
+            "thread",
+            partial(ThreadPoolExecutor, threads, thread_name_prefix="legion"),
+            threads,
+        )
+        self.processes = WorkerPool(
+            "process", partial(ProcessPoolExecutor, processes), processes
+        )
+        self.loop.set_default_executor(self.threads.executor)
+
+    def client_options(self, requirements: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+        """Derive the smallest set of intents and caches that satisfies all units."""
+        config = self.config.discord
+        intents = set(BOT_INTENTS) | set(config.intents)
+        member_cache = set(config.member_cache)
+        message_cache = False
+
+        for requires in requirements:
+            intents.update(requires["intents"])
+            member_cache.update(requires["member_cache"])
+            message_cache = message_cache or requires["message_cache"]
+
+        for flag in member_cache:
+            if flag not in MEMBER_CACHE_INTENTS:
+                raise ValueError(f"unknown member cache flag {flag!r}")
+            intents.add(MEMBER_CACHE_INTENTS[flag])
+
+        max_messages = config.max_messages if message_cache else 0
+        chunk_guilds = config.chunk_guilds and "members" in intents
+
+        LOG.info(
+            f"intents: {sorted(intents)}, member cache: {sorted(member_cache)}, "
+            f"max messages: {max_messages}, chunk guilds: {chunk_guilds}"
+        )
+
+        member_cache_flags = MemberCacheFlags.none()
+        for flag in member_cache:
+            setattr(member_cache_flags, flag, True)
+
+        options = {
+            "intents": Intents(**{name: True for name in intents}),
+            "member_cache_flags": member_cache_flags,
+            "max_messages": max_messages or None,
+            "chunk_guilds_at_startup": chunk_guilds,
+        }
+
+        if config.sharded:
+            LOG.info(
+                f"sharded, shard count: {config.shard_count or 'auto'}, "
+                f"shard ids: {config.shard_ids or 'all'}"
+            )
+            options["shard_count"] = config.shard_count or None
+            options["shard_ids"] = config.shard_ids or None
+
+        return options
+
+    def runs_unit(self, gateway: bool) -> bool:
+        """Whether this process runs a unit; gateways only run gateway units."""
+        return gateway or self.gateway is None
+
+    def starts_eagerly(self, unit: Dict[str, Any]) -> bool:
+        """Whether a unit from the manifest is eager, given the current config."""
+        if not unit["eager"]:
+            return False
+        for setting in unit["eager_if"]:
+            section, _, name = setting.partition(".")
+            if not getattr(getattr(self.config, section), name):
+                return False
+        return True
+
+    def shard_path(self, path: Path) -> Path:
+        """Per-process variant of a state file, when running a subset of shards."""
+        return shard_path(path, self.config.discord.shard_ids)
+
+    def shard_key(self, key: str) -> str:
+        """Per-process variant of a state key, when running a subset of shards."""
+        shard_ids = self.config.discord.shard_ids
+        return f"{key}.{shard_label(shard_ids)}" if shard_ids else key
+
     def sigterm(self) -> None:
         """Handle Ctrl-C or SIGTERM by stopping the event loop nicely."""
         LOG.warning("Signal received, stopping execution")
@@ -83,25 +266,156 @@ class Bot:
         self.task = asyncio.ensure_future(self.run(), loop=self.loop)
         self.loop.run_forever()
 
-    async def start_units(self):
-        for unit in self.units.values():
-            if not unit.started:
+    def spawn(self, coro: Any, label: str = "") -> asyncio.Future:
+        """Run a coroutine as a task that shutdown and reload will wait for."""
+        task = asyncio.ensure_future(coro)
+        self.track(task, label or coro.__qualname__)
+        return task
+
+    def track(self, task: asyncio.Future, label: str) -> None:
+        self.tasks[task] = label
+        task.add_done_callback(partial(self.tasks.pop))
+
+    def event_handler(self, fn: Callable) -> Callable:
+        """Track each client event as a task, and ignore events while stopping."""
+
+        @wraps(fn)
+        async def wrapped(*args, **kwargs):
+            if self.stopping:
+                metrics.incr("bot.events.refused")
+                return
+            task = asyncio.current_task()
+            if task is not None:
+                self.track(task, fn.__name__)
+                EVENT_TASK.set(task)
+            await fn(*args, **kwargs)
+
+        return wrapped
+
+    def other_tasks(self) -> List[asyncio.Future]:
+        """Tracked tasks, except the current task and the event it runs for."""
+        own = {asyncio.current_task(), EVENT_TASK.get()}
+        return [task for task in self.tasks if task not in own]
+
+    async def drain(
+        self,
+        timeout: float,
+        cancel: bool = True,
+        tasks: Optional[Iterable[asyncio.Future]] = None,
+    ) -> List[str]:
+        """
+        Wait up to `timeout` seconds for tracked tasks to finish.
+
+        When stopping, no new events arrive, so this also waits for any tasks
+        spawned while draining, and cancels whatever is left at the deadline.
+        Otherwise, only tasks already running, or the given `tasks`, are waited
+        for, and left running. The caller's own tasks are never waited for.
+        Returns descriptions of the tasks that didn't finish in time.
+        """
+        deadline = self.loop.time() + timeout
+        pending = self.other_tasks() if tasks is None else list(tasks)
+        while pending:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            LOG.info(f"waiting up to {remaining:.0f}s for {len(pending)} tasks")
+            await asyncio.wait(pending, timeout=remaining)
+            pending = [task for task in pending if not task.done()]
+            if cancel:
+                pending = self.other_tasks()
+
+        unfinished = sorted(self.tasks.get(task, "?") for task in pending)
+        if unfinished and cancel:
+            LOG.warning(f"cancelling {len(unfinished)} unfinished tasks: {unfinished}")
+            metrics.incr("bot.drain.cancelled", len(unfinished))
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending, timeout=1)
+        return unfinished
+
+    def subscribe(self, unit_type: Type[Unit]) -> None:
+        """Update lazy event subscriptions for a freshly loaded unit class."""
+        name = unit_type.__name__
+        for names in self.subscribers.values():
+            if name in names:
+                names.remove(name)
+        for event in unit_type.events():
+            self.subscribers[event].append(name)
+
+    def unit_type(self, name: str) -> Type[Unit]:
+        """Import the module for a lazy unit and return the unit class."""
+        module = import_unit(self.unit_modules[name])
+        return getattr(module, name)
+
+    async def get_unit(self, name: str) -> Optional[Unit]:
+        """Return a unit by name, importing and starting lazy units on first use."""
+        unit = self.units.get(name, None)
+        if unit is not None or name not in self.unit_modules:
+            return unit
+
+        lock = self.unit_locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            unit = self.units.get(name, None)
+            if unit is None:
+                LOG.info(f"loading unit {name} on first use")
+                unit = self.unit_type(name)(self, self.client)
+                self.units[name] = unit
+                await self.start_unit(unit)
+
+        return unit
+
+    async def dispatch_units(self, name: str, *args, **kwargs) -> None:
+        """Pass an event to every running unit with a matching handler."""
+        for unit in await self.subscribed_units(name):
+            method = getattr(unit, name, None)
+            if asyncio.iscoroutinefunction(method):
                 try:
-                    LOG.debug(f"starting unit {unit}")
-                    await unit.start()
-                    unit.started = True
+                    LOG.debug(f"dispatch {name} to {method}")
+                    await method(*args, **kwargs)
                 except Exception:
-                    LOG.exception(f"error starting unit {unit}")
+                    LOG.exception(f"error from unit {unit}.{name}")
+
+    async def subscribed_units(self, event: str) -> List[Unit]:
+        """Running units that should receive the given event."""
+        if self.ready:
+            for name in self.subscribers.get(event, []):
+                await self.get_unit(name)
+
+        return [unit for unit in self.units.values() if unit.started]
+
+    async def start_unit(self, unit: Unit) -> None:
+        if not unit.started:
+            missing = [
+                name for name in unit.INTENTS if not getattr(self.client.intents, name)
+            ]
+            if missing:
+                LOG.warning(f"unit {unit} needs intents {missing}, restart to enable")
+
+            try:
+                LOG.debug(f"starting unit {unit}")
+                with metrics.timer(f"unit.start.{type(unit).__name__}"):
+                    await unit.start()
+                unit.started = True
+            except Exception:
+                LOG.exception(f"error starting unit {unit}")
+
+    async def start_units(self):
+        await self.state.open()
+        for unit in list(self.units.values()):
+            await self.start_unit(unit)
+
+    async def stop_unit(self, unit: Unit) -> None:
+        if unit.started:
+            try:
+                LOG.debug(f"stopping unit {unit}")
+                unit.started = False
+                await unit.stop()
+            except Exception:
+                LOG.exception(f"error stopping unit {unit}")
 
     async def stop_units(self):
-        for unit in self.units.values():
-            if unit.started:
-                try:
-                    LOG.debug(f"stopping unit {unit}")
-                    unit.started = False
-                    await unit.stop()
-                except Exception:
-                    LOG.exception(f"error stopping unit {unit}")
+        for unit in list(self.units.values()):
+            await self.stop_unit(unit)
 
     async def run(self):
         for key in dir(self):
@@ -109,61 +423,214 @@ class Bot:
                 prop = getattr(self, key, None)
                 LOG.debug(f"hooking {key}: {prop}")
                 if asyncio.iscoroutinefunction(prop):
-                    self.client.event(prop)
+                    self.client.event(self.event_handler(prop))
+
+        if self.upstream:
+            # workers only need the REST api, events come from the gateway
+            LOG.info("logging in to discord api")
+            await self.client.login(self.config.discord.token)
+            await self.start_units()
+            self.ready = True
+            await self.upstream.run()
+            return
+
+        if self.gateway:
+            await self.gateway.start()
 
         LOG.info("starting discord client")
         await self.client.start(self.config.discord.token)
         LOG.info("discord client started")
 
     async def stop(self):
+        if self.stopping:
+            LOG.warning("already stopping")
+            return
+        self.stopping = True
+
         try:
+            LOG.info("draining in-flight events")
+            await self.drain(self.config.bot.drain_timeout)
+
+            if self.upstream:
+                await self.upstream.stop()
+
             await self.stop_units()
             self.units.clear()
 
+            LOG.info("saving unit state")
+            try:
+                await self.state.close()
+            except Exception:
+                LOG.exception("failed to save unit state")
+
+            LOG.info("shutting down worker pools")
+            timeout = self.config.bot.drain_timeout
+            await asyncio.gather(
+                self.threads.shutdown(timeout), self.processes.shutdown(timeout)
+            )
+
+            if self.gateway:
+                LOG.info("stopping workers")
+                await self.gateway.stop()
+
             LOG.info("closing discord client")
             await self.client.close()
         finally:
             self.loop.stop()
             LOG.info("does this... unit... have...")
 
-    def check_command(self, message: Message) -> Optional[Match]:
-        if message.author.id == self.client.user.id:
+    def command_settings(self, name: str, command: Command) -> Command:
+        """The command with any overrides from config applied."""
+        cached = self.command_overrides.get(name)
+        if cached is not None and cached[0] is command:
+            return cached[1]
+
+        overrides = dict(self.config.bot.commands.get(name, {}))
+        for key in list(overrides):
+            if key not in COMMAND_OVERRIDES:
+                LOG.warning(f"ignoring unknown setting {key!r} for command {name!r}")
+                del overrides[key]
+        if overrides.get("overflow", "queue") not in OVERFLOW:
+            LOG.warning(f"ignoring unknown overflow for command {name!r}")
+            del overrides["overflow"]
+        if "limits" in overrides:
+            overrides["limits"] = {
+                scope: (tokens, per)
+                for scope, (tokens, per) in overrides["limits"].items()
+            }
+        if "cost" in overrides or "limits" in overrides:
+            try:
+                check_limits(
+                    overrides.get("limits", command.limits),
+                    overrides.get("cost", command.cost),
+                )
+            except ValueError as e:
+                LOG.warning(f"ignoring rate limits for command {name!r}: {e}")
+                overrides.pop("cost", None)
+                overrides.pop("limits", None)
+
+        effective = evolve(command, **overrides) if overrides else command
+        self.command_overrides[name] = (command, effective)
+        return effective
+
+    def command_semaphore(
+        self, name: str, command: Command
+    ) -> Optional[asyncio.Semaphore]:
+        """Shared semaphore for commands with a concurrency limit."""
+        if command.max_concurrency <= 0:
             return None
-
-        name = self.client.user.name
-        nick = name
-
-        if isinstance(message.channel, DMChannel):
-            match = re.match(
-                rf"(?:(?P<mention>@?{name}:?)?\s*|!)"
-                r"(?P<command>\w+)(?:\s+(?P<args>.+))?",
-                message.clean_content,
-                re.IGNORECASE,
+        slots = self.command_slots.get(name)
+        if slots is None or slots[0] != command.max_concurrency:
+            slots = (
+                command.max_concurrency,
+                asyncio.Semaphore(command.max_concurrency),
             )
-            if match:
-                return match
+            self.command_slots[name] = slots
+        return slots[1]
+
+    async def react(self, message: MessageView, emoji: str) -> None:
+        try:
+            await message.add_reaction(emoji)
+        except Exception:
+            LOG.exception(f"failed to add {emoji} reaction")
+
+    async def throttled(
+        self, message: MessageView, name: str, command: Command
+    ) -> bool:
+        """Take rate limit tokens for a command, or react if it has to wait."""
+        if not command.limits:
+            return False
+
+        ids = {
+            "user": message.author.id,
+            "channel": message.channel.id,
+            "guild": message.guild.id if message.guild else None,
+        }
+        wait = self.limiter.acquire(name, command.limits, command.cost, ids)
+        if not wait:
+            return False
+
+        LOG.debug(f"throttled {name} from {message.author} for {wait:.1f}s")
+        metrics.incr("commands.throttled")
+        if self.limiter.warn(name, message.author.id, wait):
+            await self.react(message, THROTTLED)
+        return True
+
+    async def throttled_at_gateway(self, message: MessageView) -> bool:
+        """
+        Apply rate limits before forwarding a command to a worker.
+
+        Workers each see only some channels, so limits are enforced here, where
+        every command passes through. Unknown commands and invalid arguments
+        are left for the worker to answer, and spend no tokens.
+        """
+        if not message.command:
+            return False
+
+        _, name, args = message.command
+        name = name.casefold()
+        if name not in COMMANDS:
+            return False
 
+        command = self.command_settings(name, COMMANDS[name])
+        if not command.args.fullmatch(args or ""):
+            return False
+        return await self.throttled(message, name, command)
+
+    async def call_command(
+        self,
+        method: Callable,
+        message: MessageView,
+        match: Match,
+        queue: Optional[asyncio.Semaphore] = None,
+    ) -> Any:
+        if queue is not None:
+            async with queue:
+                return await self.call_command(method, message, match)
+
+        kwargs = match.groupdict()
+        if kwargs:
+            LOG.debug(f"COMMAND {method.__qualname__}({message}, **{kwargs})")
+            return await method(message, **kwargs)
+        else:
+            pargs = match.groups()
+            LOG.debug(f"COMMAND {method.__qualname__}({message}, *{pargs})")
+            return await method(message, *pargs)
+
+    def check_command(self, view: MessageView) -> Optional[CommandMatch]:
+        if view.author.id == self.client.user.id:
             return None
 
-        if message.guild:
-            nick = message.guild.me.display_name
+        name = self.client.user.name
+        if view.direct:
+            matcher = command_matcher(name, name, direct=True)
+        else:
+            nick = view.guild.me.display_name if view.guild else name
+            matcher = command_matcher(name, nick)
 
-        match = re.match(
-            rf"(?:(?P<mention>@?(?:{name}|{nick}):?)\s+|!)"
-            r"(?P<command>\w+)(?:\s+(?P<args>.+))?",
-            message.clean_content,
-            re.IGNORECASE,
-        )
-        if match:
-            return match
+        match = matcher.match(view.clean_content)
+        return match.groups() if match else None  # type: ignore
 
-        return None
+    async def reply(self, channel: Messageable, content: str) -> None:
+        """Send a message to a channel, via the gateway when running as a worker."""
+        if self.upstream:
+            await self.upstream.reply(channel.id, content)
+        else:
+            await channel.send(content)
 
-    async def dispatch_command(self, message: Message, match: Optional[Match]):
-        if not match:
+    async def dispatch_command(self, message: MessageView) -> None:
+        if not message.command:
             return
 
-        mention, name, args = match.groups()
+        await self.run_command(message, *message.command)
+
+    async def run_command(
+        self,
+        message: MessageView,
+        mention: Optional[str],
+        name: str,
+        args: Optional[str],
+    ) -> None:
         name = name.casefold()
 
         if name not in COMMANDS:
@@ -171,23 +638,41 @@ class Bot:
                 f"unknown command from {message.author} on {message.channel}: "
                 f"{name!r} {args!r}"
             )
+            suggestions = COMMANDS.suggest(name)
+            # at most one hint per user each minute, in case it wasn't for us
+            if suggestions and self.limiter.warn("", message.author.id, 60):
+                await self.reply(
+                    message.channel,
+                    f"{message.author.mention} unknown command {name!r}, "
+                    f"did you mean {', '.join(suggestions)}?",
+                )
             return
 
-        command = COMMANDS[name]
+        command = self.command_settings(name, COMMANDS[name])
 
         if command.admin_only and message.author.id not in self.config.bot.admins:
             LOG.warning(
                 f"user {message.author}/{message.author.id} "
                 f"requested admin command {name}"
             )
-            await message.channel.send(f"user {message.author.id} is not an admin")
+            await self.reply(
+                message.channel, f"user {message.author.id} is not an admin"
+            )
             return
 
-        if command.class_name not in self.units:
+        if command.process_local and (self.gateway or self.upstream):
+            await self.reply(
+                message.channel,
+                f"{message.author.mention} {name!r} is not available in split mode, "
+                "where it would only reach one process",
+            )
+            return
+
+        unit = await self.get_unit(command.class_name)
+        if unit is None:
             LOG.error(f"unknown unit {command.class_name!r}")
             return
 
-        unit = self.units[command.class_name]
         method = getattr(unit, command.method_name, None)
         if method is None:
             LOG.error(f"unknown unit method {command.class_name}.{command.method_name}")
@@ -195,37 +680,93 @@ class Bot:
 
         match = command.args.fullmatch(args or "")
         if not match:
-            await message.channel.send(
-                f"{message.author.mention} invalid arguments for {name!r}"
+            await self.reply(
+                message.channel,
+                f"{message.author.mention} invalid arguments for {name!r}",
             )
             return
 
-        kwargs = match.groupdict()
-        if kwargs:
-            LOG.debug(f"COMMAND {method.__qualname__}({message}, **{kwargs})")
-            response = await method(message, **kwargs)
-        else:
-            pargs = match.groups()
-            LOG.debug(f"COMMAND {method.__qualname__}({message}, *{pargs})")
-            response = await method(message, *pargs)
+        # only calls that would actually run spend rate limit tokens; in split
+        # mode the gateway already took them, before picking a worker
+        if not self.upstream and await self.throttled(message, name, command):
+            return
+
+        semaphore = self.command_semaphore(name, command)
+        queue: Optional[asyncio.Semaphore] = None
+        if semaphore is not None:
+            if not semaphore.locked():
+                # claim a free slot now, before the next message can look
+                await semaphore.acquire()
+            elif command.overflow == "reject":
+                LOG.debug(f"rejected {name} from {message.author}, at capacity")
+                metrics.incr(f"commands.{name}.rejected")
+                await self.react(message, BUSY)
+                return
+            else:
+                metrics.incr(f"commands.{name}.queued")
+                queue, semaphore = semaphore, None
+
+        # name the command in any report of unfinished tasks
+        task = asyncio.current_task()
+        if task in self.tasks:
+            self.tasks[task] = f"{name} from {message.author}"
+
+        # the timeout covers time spent queued as well as running
+        timeout = command.timeout or self.config.bot.command_timeout
+        try:
+            response = await asyncio.wait_for(
+                self.call_command(method, message, match, queue), timeout or None
+            )
+        except asyncio.TimeoutError:
+            LOG.warning(f"command {name} from {message.author} timed out")
+            metrics.incr(f"commands.{name}.timeout")
+            await self.reply(
+                message.channel, f"{message.author.mention} {name!r} timed out"
+            )
+            return
+        except asyncio.CancelledError:
+            LOG.warning(f"command {name} from {message.author} cancelled")
+            metrics.incr(f"commands.{name}.cancelled")
+            raise
+        finally:
+            if semaphore is not None:
+                semaphore.release()
 
         if response:
-            await message.channel.send(response)
+            await self.reply(message.channel, response)
+
+    async def dispatch_message(self, view: MessageView) -> None:
+        if view.command:
+            await self.dispatch_command(view)
+        else:
+            await self.dispatch_units("on_message", view)
 
     async def on_ready(self):
         LOG.info(f"discord client ready as user {self.client.user}")
         await self.start_units()
 
-    @dispatch
-    async def on_message(self, message: Message) -> bool:
+        if not self.ready:
+            self.ready = True
+            ready_time = time.monotonic() - self.start_time
+            metrics.timing("bot.ready", ready_time)
+            LOG.info(f"ready in {ready_time:.2f}s")
+
+    async def on_message(self, message: Message) -> None:
         LOG.debug(f"message received: {message}")
 
-        match = self.check_command(message)
-        if match:
-            await self.dispatch_command(message, match)
-            return False
+        view = MessageView(message)
+        view.command = self.check_command(view)
 
-        return True
+        if self.gateway:
+            if view.command and await self.throttled_at_gateway(view):
+                return
+            await self.gateway.forward_message(view)
+            if view.command:
+                return
+            await self.dispatch_units("on_message", view)
+            return
+
+        await self.dispatch_message(view)
 
     @dispatch
     async def on_reaction_add(self, reaction: Reaction, user: User) -> None:
@@ -234,3 +775,49 @@ class Bot:
     @dispatch
     async def on_raw_reaction_add(self, payload: RawReactionActionEvent) -> None:
         LOG.debug(f"raw reaction: {payload}")
+        if self.gateway:
+            await self.gateway.forward_reaction(payload)
+
+    @dispatch
+    async def on_guild_available(self, guild: Guild) -> None:
+        LOG.debug(f"guild available: {guild}")
+
+    @dispatch
+    async def on_guild_unavailable(self, guild: Guild) -> None:
+        LOG.debug(f"guild unavailable: {guild}")
+
+    @dispatch
+    async def on_guild_join(self, guild: Guild) -> None:
+        LOG.debug(f"joined guild: {guild}")
+
+    @dispatch
+    async def on_guild_remove(self, guild: Guild) -> None:
+        LOG.debug(f"removed from guild: {guild}")
+        if self.gateway:
+            await self.gateway.remove_guild(guild.id)
+
+    @dispatch
+    async def on_guild_update(self, before: Guild, after: Guild) -> None:
+        LOG.debug(f"guild updated: {after}")
+        if self.gateway:
+            self.gateway.invalidate(after.id)
+
+    @dispatch
+    async def on_guild_channel_create(self, channel: GuildChannel) -> None:
+        LOG.debug(f"channel created: {channel}")
+        if self.gateway:
+            self.gateway.invalidate(channel.guild.id)
+
+    @dispatch
+    async def on_guild_channel_delete(self, channel: GuildChannel) -> None:
+        LOG.debug(f"channel deleted: {channel}")
+        if self.gateway:
+            self.gateway.invalidate(channel.guild.id)
+
+    @dispatch
+    async def on_guild_channel_update(
+        self, before: GuildChannel, after: GuildChannel
+    ) -> None:
+        LOG.debug(f"channel updated: {after}")
+        if self.gateway:
+            self.gateway.invalidate(after.guild.id)
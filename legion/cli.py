@@ -1,16 +1,21 @@
 # Copyright 2020 John Reese
 # Licensed under the MIT License
 
+import asyncio
 import logging
+import os
 from pathlib import Path
+from typing import List, Optional
 
 import click
-from discord import Client
 
 from legion import __version__
-from legion.bot import Bot
 from legion.config import load_config, Config
 from legion.log import init_logger
+from legion.units import MANIFEST_PATH
+
+# subcommands import their own dependencies, so lightweight maintenance
+# commands don't pay for discord.py and every unit at startup
 
 LOG = logging.getLogger(__name__)
 
@@ -40,19 +45,175 @@ def main(ctx: click.Context, debug: bool, config: str):
     )
 
 
+def global_args(ctx: click.Context) -> List[str]:
+    """Global options to pass along to child processes."""
+    params = ctx.find_root().params
+    args = ["--config", params["config"]]
+    if params["debug"]:
+        args.append("--debug")
+    return args
+
+
 @main.command()
+@click.option("--profile-startup", is_flag=True, help="Report import and startup times")
+@click.option("--profile", is_flag=True, help="Sample where time goes until stopped")
+@click.option("--shards", type=int, default=0, help="Total number of shards to run")
+@click.option(
+    "--processes",
+    type=int,
+    default=1,
+    help="Supervise this many bot processes, each running a group of shards",
+)
+@click.option("--shard-ids", default="", hidden=True, help="Shards for this process")
+@click.option("--workers", type=int, default=None, help="Run units in worker processes")
+@click.option("--worker", type=int, default=None, hidden=True, help="Worker id")
+@click.option("--worker-socket", default="", hidden=True, help="Gateway socket")
 @click.pass_context
-def run(ctx: click.Context):
+def run(
+    ctx: click.Context,
+    profile_startup: bool,
+    profile: bool,
+    shards: int,
+    processes: int,
+    shard_ids: str,
+    workers: Optional[int],
+    worker: Optional[int],
+    worker_socket: str,
+):
     """Start the bot"""
     config: Config = ctx.obj
-    bot = Bot(config)
-    bot.start()
+    if not config.discord.token:
+        raise click.UsageError("discord.token missing from config")
+
+    if shards and processes > 1:
+        from legion.sharding import Supervisor, shard_commands
+
+        supervisor = Supervisor(shard_commands(global_args(ctx), shards, processes))
+        asyncio.run(supervisor.run())
+        return
+
+    if shards:
+        config.discord.sharded = True
+        config.discord.shard_count = shards
+    if shard_ids:
+        from legion.sharding import shard_path
+
+        if not config.discord.shard_count:
+            raise click.UsageError("--shard-ids requires a shard count")
+        config.discord.shard_ids = [int(i) for i in shard_ids.split(",")]
+
+        # each shard process gets its own log file
+        init_logger(
+            stdout=True,
+            file_path=config.bot.log
+            and shard_path(config.bot.log, config.discord.shard_ids),
+            debug=ctx.find_root().params["debug"] or config.bot.debug,
+            log_megabytes=config.bot.log_megabytes,
+            log_count=config.bot.log_count,
+        )
+        LOG.info(f"running as pid {os.getpid()}")
+
+    if workers is not None:
+        config.bot.workers = workers
+    if worker is not None:
+        from legion.sharding import suffixed
+
+        config.bot.socket_path = Path(worker_socket)
+        init_logger(
+            stdout=True,
+            file_path=config.bot.log and suffixed(config.bot.log, f"worker{worker}"),
+            debug=ctx.find_root().params["debug"] or config.bot.debug,
+            log_megabytes=config.bot.log_megabytes,
+            log_count=config.bot.log_count,
+        )
+        LOG.info(f"running worker {worker} as pid {os.getpid()}")
+
+    if profile_startup:
+        from legion.profiling import ImportProfiler
+
+        profiler = ImportProfiler()
+        profiler.install()
+
+    from legion.bot import Bot
+
+    bot = Bot(config, worker=worker, args=global_args(ctx))
+
+    if profile_startup:
+        profiler.uninstall()
+        for line in profiler.report():
+            LOG.info(line)
+
+    if not profile:
+        bot.start()
+        return
+
+    from legion.profiling import SamplingProfiler, profile_path
+
+    sampler = SamplingProfiler()
+    sampler.start()
+    try:
+        bot.start()
+    finally:
+        sampler.stop()
+        path = sampler.write(profile_path(config.bot.profile_dir))
+        for line in sampler.report():
+            LOG.info(line)
+        LOG.info(f"collapsed stacks written to {path}")
+
+
+@main.command("rebuild-stats")
+@click.pass_context
+def rebuild_quote_stats(ctx: click.Context):
+    """Rebuild quote leaderboard tables"""
+    from legion.units.quotes import rebuild_stats
+
+    config: Config = ctx.obj
+    count = asyncio.run(rebuild_stats(config.quotes))
+    click.echo(f"rebuilt quote stats from {count} quotes")
+
 
-    return
-    client = Client()
+@main.command("seinfeld-index")
+@click.pass_context
+def seinfeld_index(ctx: click.Context):
+    """Build the Seinfeld full text search index"""
+    from legion.units.seinfeld import SeinfeldIndex
+
+    config: Config = ctx.obj
+    db_path = config.seinfeld.db_path
+    index_path = config.seinfeld.index_path
+    count = SeinfeldIndex.build(db_path, index_path)
+    click.echo(f"indexed {count} lines from {db_path} into {index_path}")
 
-    @client.event
-    async def on_ready():
-        print(f"ready as user {client.user}")
 
-    client.run(config.discord.token)
+@main.command("twitter-standin")
+@click.option("--host", default="127.0.0.1", help="address to listen on")
+@click.option("--port", default=8080, help="port to listen on")
+@click.option("--rate", default=1.0, help="simulated tweets per minute")
+@click.option("--limit", default=15, help="timeline requests per rate limit window")
+def twitter_standin(host: str, port: int, rate: float, limit: int):
+    """Serve a local stand-in for the Twitter API"""
+    from legion.standin import TwitterStandin
+
+    standin = TwitterStandin(rate=rate, limit=limit)
+    click.echo(f'set twitter.api_url = "http://{host}:{port}/{{version}}"')
+    standin.run(host, port)
+
+
+@main.command()
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False, resolve_path=True),
+    default=str(MANIFEST_PATH),
+    help="path to write the manifest",
+)
+def manifest(output: str):
+    """Regenerate the unit command manifest"""
+    from legion.unit import Unit
+    from legion.units import write_manifest
+
+    data = Unit.build_manifest()
+    write_manifest(data, Path(output))
+    click.echo(
+        f"wrote {len(data['commands'])} commands "
+        f"from {len(data['modules'])} unit modules to {output}"
+    )
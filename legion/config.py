@@ -2,7 +2,7 @@
 # Licensed under the MIT License
 
 from pathlib import Path
-from typing import Any, Mapping, Optional, List, Dict
+from typing import Any, Mapping, List, Dict
 
 import tomlkit
 from attr import dataclass, field, fields
@@ -12,10 +12,30 @@ from attr import dataclass, field, fields
 class BotConfig:
     admins: List[int] = field(factory=list)
     debug: bool = False
-    log: Optional[Path] = field(default=Path("output.log"), converter=Path)
+    log: Path = field(default=Path("output.log"), converter=Path)
     log_megabytes: int = 64
     log_count: int = 2
     uvloop: bool = False
+    lazy_units: bool = False
+    # split mode: run units in this many worker processes behind a gateway
+    workers: int = 0
+    socket_path: Path = field(default=Path("legion.sock"), converter=Path)
+    # pools for units to offload blocking or cpu bound work, 0 for cpu count
+    thread_workers: int = 8
+    process_workers: int = 0
+    # seconds before a command is cancelled, unless it sets its own; 0 for none
+    command_timeout: float = 60.0
+    # seconds to let in-flight events and commands finish on stop or reload
+    drain_timeout: float = 30.0
+    # where `!profile` and `legion run --profile` write collapsed stacks
+    profile_dir: Path = field(default=Path("profiles"), converter=Path)
+    # seconds between logging memory use and growth, 0 to disable
+    memory_sample_interval: float = 0.0
+    # key/value state for units, written at most every flush interval seconds
+    state_path: Path = field(default=Path("legion.db"), converter=Path)
+    state_flush_interval: float = 5.0
+    # per command overrides of @command settings, eg [bot.commands.grab]
+    commands: Dict[str, Dict[str, Any]] = field(factory=dict)
 
 
 @dataclass
@@ -27,12 +47,22 @@ class ChatlogConfig:
 
 @dataclass
 class DiscordConfig:
-    token: str
+    token: str = ""
+    # enabled in addition to whatever the loaded units require
+    intents: List[str] = field(factory=list)
+    member_cache: List[str] = field(factory=list)
+    # message cache size when any unit needs it, or 0 to never cache messages
+    max_messages: int = 1000
+    chunk_guilds: bool = False
+    # run an AutoShardedClient; shard_count 0 uses the count discord recommends
+    sharded: bool = False
+    shard_count: int = 0
+    shard_ids: List[int] = field(factory=list)
 
 
 @dataclass
 class QuotesConfig:
-    db_path: Optional[Path] = field(default=Path("quotes.db"), converter=Path)
+    db_path: Path = field(default=Path("quotes.db"), converter=Path)
     grab_reactions: List[str] = ["💭"]
     tweet_grabs: bool = True
     tweet_format: str = "{text}"
@@ -40,7 +70,11 @@ class QuotesConfig:
 
 @dataclass
 class SeinfeldConfig:
-    db_path: Optional[Path] = field(default=Path("seinfeld.db"), converter=Path)
+    db_path: Path = field(default=Path("seinfeld.db"), converter=Path)
+    index_path: Path = field(default=Path("seinfeld-index.db"), converter=Path)
+    pool_size: int = 2
+    preload: bool = False
+    passage_cache_size: int = 256
 
 
 @dataclass
@@ -49,6 +83,15 @@ class TwitterConfig:
     consumer_secret: str = ""
     access_key: str = ""
     access_secret: str = ""
+    api_url: str = ""
+    poll_min: int = 60
+    poll_max: int = 600
+    # cursor file from older versions, read once to move into bot state
+    state_path: Path = field(default=Path("twitter.json"), converter=Path)
+    outbox_path: Path = field(default=Path("twitter.db"), converter=Path)
+    outbox_batch: int = 10
+    outbox_attempts: int = 8
+    outbox_backoff: int = 30
     timeline_channels: Dict[str, List[str]] = field(factory=dict)
 
 
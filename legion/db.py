@@ -0,0 +1,26 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator
+
+import aiosqlite
+
+BUSY_TIMEOUT = 10000  # milliseconds
+
+
+@asynccontextmanager
+async def connect(path: Path) -> AsyncIterator[aiosqlite.Connection]:
+    """
+    Open an autocommit sqlite connection that is safe to share between processes.
+
+    WAL mode lets readers continue while another shard process is writing, and
+    the busy timeout makes writers wait for each other instead of failing.
+    Writers should use `BEGIN IMMEDIATE` so that concurrent transactions
+    serialize on the write lock rather than deadlocking on upgrade.
+    """
+    async with aiosqlite.connect(path, isolation_level=None) as conn:
+        await conn.execute("PRAGMA journal_mode = WAL")
+        await conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+        yield conn
@@ -0,0 +1,413 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+"""
+Split mode: one gateway process holds the Discord connection, and forwards
+compact events over a Unix socket to worker processes that run the units.
+
+Frames are a four byte big-endian length followed by a JSON object. The gateway
+matches commands before forwarding, and sends the bot user before a worker's
+first event, and a snapshot of each guild the first time a worker sees an event
+from it, so workers can rebuild real discord.py objects without a gateway
+connection of their own. Workers log in to the REST API only, and send replies
+back through the gateway so that all messages share one connection and one set
+of rate limits.
+"""
+
+import asyncio
+import json
+import logging
+import struct
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence, Set, TYPE_CHECKING
+
+from discord import (
+    ClientUser,
+    DMChannel,
+    Guild,
+    Member,
+    Message,
+    PartialEmoji,
+    RawReactionActionEvent,
+    TextChannel,
+)
+
+from legion import metrics
+from legion.sharding import Supervisor, legion_command
+from legion.view import MessageView
+
+if TYPE_CHECKING:
+    from legion.bot import Bot
+
+LOG = logging.getLogger(__name__)
+
+FRAME = struct.Struct("!I")
+MAX_FRAME = 4 * 1024 * 1024
+
+Frame = Dict[str, Any]
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[Frame]:
+    """Read one frame, or return None if the other side has gone away."""
+    try:
+        header = await reader.readexactly(FRAME.size)
+        (size,) = FRAME.unpack(header)
+        if size > MAX_FRAME:
+            raise ValueError(f"frame of {size} bytes exceeds limit")
+        return json.loads(await reader.readexactly(size))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+def write_frame(writer: asyncio.StreamWriter, frame: Frame) -> None:
+    body = json.dumps(frame, separators=(",", ":")).encode()
+    writer.write(FRAME.pack(len(body)) + body)
+
+
+def user_data(user: Any) -> Dict[str, Any]:
+    return {
+        "id": str(user.id),
+        "username": user.name,
+        "discriminator": user.discriminator,
+        "avatar": user.avatar,
+        "bot": user.bot,
+    }
+
+
+def member_data(member: Member) -> Dict[str, Any]:
+    return {"user": user_data(member), "nick": member.nick, "roles": []}
+
+
+def channel_data(channel: Any) -> Dict[str, Any]:
+    if isinstance(channel, DMChannel):
+        return {"id": str(channel.id), "type": 1}
+    return {
+        "id": str(channel.id),
+        "name": channel.name,
+        "type": 0,
+        "position": channel.position,
+    }
+
+
+def guild_data(guild: Guild) -> Dict[str, Any]:
+    """Enough of a guild for workers to resolve its text channels and nick."""
+    return {
+        "id": str(guild.id),
+        "name": guild.name,
+        "channels": [channel_data(channel) for channel in guild.text_channels],
+        "members": [member_data(guild.me)],
+    }
+
+
+def message_data(message: Message) -> Dict[str, Any]:
+    data = {
+        "id": str(message.id),
+        "type": 0,
+        "content": message.content,
+        "timestamp": message.created_at.isoformat(),
+        "edited_timestamp": None,
+        "author": user_data(message.author),
+        "attachments": [],
+        "embeds": [],
+        "mentions": [],
+        "mention_roles": [],
+        "mention_everyone": False,
+        "pinned": False,
+        "tts": False,
+    }
+    if message.guild:
+        data["member"] = {"nick": getattr(message.author, "nick", None), "roles": []}
+    return data
+
+
+class WorkerConnection:
+    def __init__(self, worker: int, writer: asyncio.StreamWriter):
+        self.worker = worker
+        self.writer = writer
+        self.user = False
+        self.guilds: Set[int] = set()
+
+
+class GatewayServer:
+    """Gateway side of split mode: runs the workers and forwards events to them."""
+
+    def __init__(self, bot: "Bot", path: Path, workers: int, args: Sequence[str]):
+        self.bot = bot
+        self.path = path
+        self.workers = workers
+        self.connections: Dict[int, WorkerConnection] = {}
+        self.supervisor = Supervisor(
+            {
+                f"worker{worker}": legion_command(
+                    args,
+                    "run",
+                    "--worker",
+                    str(worker),
+                    "--worker-socket",
+                    str(path),
+                )
+                for worker in range(workers)
+            }
+        )
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        if self.path.exists():
+            self.path.unlink()
+        self.server = await asyncio.start_unix_server(self.handle, path=str(self.path))
+        LOG.info(f"gateway listening on {self.path} for {self.workers} workers")
+        self.supervisor.start()
+
+    async def stop(self) -> None:
+        # workers drain before exiting, and may still send replies until then
+        self.supervisor.stop()
+        await self.supervisor.wait()
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        for connection in list(self.connections.values()):
+            connection.writer.close()
+        if self.path.exists():
+            self.path.unlink()
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        hello = await read_frame(reader)
+        if not hello or hello.get("t") != "hello":
+            writer.close()
+            return
+
+        worker = int(hello["worker"])
+        connection = WorkerConnection(worker, writer)
+        self.connections[worker] = connection
+        LOG.info(f"worker {worker} connected")
+        self.send_user(connection)
+
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                if frame["t"] == "reply":
+                    await self.reply(frame)
+        finally:
+            if self.connections.get(worker) is connection:
+                del self.connections[worker]
+            writer.close()
+            LOG.warning(f"worker {worker} disconnected")
+
+    async def reply(self, frame: Frame) -> None:
+        channel_id = int(frame["channel_id"])
+        try:
+            # DMs opened by a worker aren't in the gateway's cache yet
+            channel = self.bot.client.get_channel(
+                channel_id
+            ) or await self.bot.client.fetch_channel(channel_id)
+        except Exception:
+            LOG.warning(f"reply to unknown channel {channel_id}")
+            return
+        try:
+            await channel.send(frame["content"])
+            metrics.incr("gateway.replies")
+        except Exception:
+            LOG.exception(f"failed to send reply to {channel}")
+
+    def send_user(self, connection: WorkerConnection) -> None:
+        """Tell a worker who the bot is, once the gateway has logged in."""
+        user = self.bot.client.user
+        if user is not None:
+            write_frame(connection.writer, {"t": "user", "d": user_data(user)})
+            connection.user = True
+
+    def route(self, channel_id: int) -> Optional[WorkerConnection]:
+        """Pick a worker by channel, so each channel's events stay in order."""
+        connection = self.connections.get(channel_id % self.workers, None)
+        if connection is None and self.connections:
+            connections = sorted(self.connections)
+            connection = self.connections[connections[channel_id % len(connections)]]
+        return connection
+
+    async def forward(self, channel_id: int, guild: Optional[Guild], frame: Frame):
+        connection = self.route(channel_id)
+        if connection is None:
+            LOG.debug(f"no workers connected, dropping {frame['t']}")
+            metrics.incr("gateway.dropped")
+            return
+
+        if not connection.user:
+            self.send_user(connection)
+        if guild is not None and guild.id not in connection.guilds:
+            write_frame(connection.writer, {"t": "guild", "d": guild_data(guild)})
+            connection.guilds.add(guild.id)
+        write_frame(connection.writer, frame)
+        metrics.incr("gateway.forwarded")
+        await connection.writer.drain()
+
+    async def forward_message(self, message: MessageView) -> None:
+        frame = {
+            "t": "message",
+            "channel": channel_data(message.channel),
+            "guild_id": str(message.guild.id) if message.guild else None,
+            "d": message_data(message),
+            "clean_content": message.clean_content,
+            "command": message.command,
+        }
+        await self.forward(message.channel.id, message.guild, frame)
+
+    async def forward_reaction(self, payload: RawReactionActionEvent) -> None:
+        guild = self.bot.client.get_guild(payload.guild_id or 0)
+        data = {
+            "message_id": str(payload.message_id),
+            "channel_id": str(payload.channel_id),
+            "user_id": str(payload.user_id),
+        }
+        # discord.py only treats a missing guild id as a direct message
+        if payload.guild_id:
+            data["guild_id"] = str(payload.guild_id)
+        frame = {
+            "t": "raw_reaction_add",
+            "d": data,
+            "emoji": payload.emoji.to_dict(),
+            "member": member_data(payload.member) if payload.member else None,
+        }
+        await self.forward(payload.channel_id, guild, frame)
+
+    async def remove_guild(self, guild_id: int) -> None:
+        for connection in self.connections.values():
+            connection.guilds.discard(guild_id)
+            write_frame(connection.writer, {"t": "guild_remove", "id": str(guild_id)})
+
+    def invalidate(self, guild_id: int) -> None:
+        """Resend a guild snapshot to each worker before its next event."""
+        for connection in self.connections.values():
+            connection.guilds.discard(guild_id)
+
+
+class GatewayClient:
+    """Worker side of split mode: rebuilds forwarded events and runs the units."""
+
+    def __init__(self, bot: "Bot", path: Path, worker: int):
+        self.bot = bot
+        self.path = path
+        self.worker = worker
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    @property
+    def state(self) -> Any:
+        return self.bot.client._connection
+
+    async def connect(self) -> asyncio.StreamReader:
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(str(self.path))
+                write_frame(self.writer, {"t": "hello", "worker": self.worker})
+                await self.writer.drain()
+                LOG.info(f"worker {self.worker} connected to gateway {self.path}")
+                return reader
+            except OSError as e:
+                LOG.warning(f"gateway {self.path} unavailable, retrying: {e}")
+                await asyncio.sleep(1)
+
+    async def run(self) -> None:
+        """Receive events from the gateway until stopped, reconnecting as needed."""
+        while not self.bot.stopping:
+            reader = await self.connect()
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                try:
+                    self.handle(frame)
+                except Exception:
+                    LOG.exception(f"failed to handle {frame['t']} from gateway")
+            LOG.warning("lost connection to gateway")
+
+    async def stop(self) -> None:
+        if self.writer:
+            self.writer.close()
+
+    def handle(self, frame: Frame) -> None:
+        kind = frame["t"]
+        if self.bot.stopping and kind in ("message", "raw_reaction_add"):
+            metrics.incr("bot.events.refused")
+            return
+
+        if kind == "user":
+            # login() alone leaves the client user unset
+            self.state.user = ClientUser(state=self.state, data=frame["d"])
+
+        elif kind == "guild":
+            self.add_guild(frame["d"])
+
+        elif kind == "guild_remove":
+            guild = self.state._get_guild(int(frame["id"]))
+            if guild is not None:
+                self.state._remove_guild(guild)
+
+        elif kind == "message":
+            # like discord.py, run each event as its own task
+            view = MessageView(
+                self.message(frame), frame["clean_content"], frame["command"]
+            )
+            self.bot.spawn(self.bot.dispatch_message(view), "message")
+
+        elif kind == "raw_reaction_add":
+            payload = RawReactionActionEvent(
+                frame["d"], PartialEmoji.from_dict(frame["emoji"]), "REACTION_ADD"
+            )
+            guild = self.state._get_guild(payload.guild_id)
+            if guild is not None and frame["member"]:
+                payload.member = Member(
+                    data=frame["member"], guild=guild, state=self.state
+                )
+            self.bot.spawn(
+                self.bot.dispatch_units("on_raw_reaction_add", payload),
+                "raw_reaction_add",
+            )
+
+    def add_guild(self, data: Dict[str, Any]) -> Guild:
+        old = self.state._get_guild(int(data["id"]))
+        if old is not None:
+            self.state._remove_guild(old)
+        guild = Guild(data=data, state=self.state)
+        for channel in data["channels"]:
+            guild._add_channel(TextChannel(state=self.state, guild=guild, data=channel))
+        self.state._add_guild(guild)
+        return guild
+
+    def message(self, frame: Frame) -> Message:
+        channel: Any
+        data = frame["d"]
+        if frame["guild_id"] is None:
+            channel = self.state._get_private_channel(int(frame["channel"]["id"]))
+            if channel is None:
+                channel = DMChannel(
+                    me=self.bot.client.user,
+                    state=self.state,
+                    data={**frame["channel"], "recipients": [data["author"]]},
+                )
+                self.state._add_private_channel(channel)
+        else:
+            guild = self.state._get_guild(int(frame["guild_id"]))
+            channel = guild.get_channel(int(frame["channel"]["id"]))
+            if channel is None:
+                channel = TextChannel(
+                    state=self.state, guild=guild, data=frame["channel"]
+                )
+                guild._add_channel(channel)
+
+        message = Message(state=self.state, channel=channel, data=data)
+        # mentions were already resolved by the gateway's member cache
+        message._cs_clean_content = frame["clean_content"]
+        return message
+
+    async def reply(self, channel_id: int, content: str) -> None:
+        if self.writer is None:
+            LOG.warning(f"not connected to gateway, dropping reply to {channel_id}")
+            return
+        write_frame(
+            self.writer,
+            {"t": "reply", "channel_id": str(channel_id), "content": content},
+        )
+        await self.writer.drain()
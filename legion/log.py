@@ -20,6 +20,9 @@ def init_logger(
     """Initialize the logging system for stdout and an optional log file."""
 
     log = logging.getLogger("")
+    for existing in list(log.handlers):
+        log.removeHandler(existing)
+        existing.close()
 
     level = logging.DEBUG if debug else logging.INFO
     log.setLevel(level)
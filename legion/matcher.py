@@ -0,0 +1,124 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+"""
+Precompiled matching of command messages.
+
+Run `python -m legion.matcher` to benchmark against simulated chat traffic.
+"""
+
+import random
+import re
+import time
+from functools import lru_cache
+from typing import Callable, FrozenSet, List, Match, Optional, Tuple
+
+COMMAND = r"(?P<command>\w+)(?:\s+(?P<args>.+))?"
+
+
+class CommandMatcher:
+    """
+    Matches commands addressed to a bot with the given name and nickname.
+
+    Guild messages must start with "!" or a mention of the bot, so anything
+    else is rejected by looking at the first character, before any regex runs.
+    Direct messages don't need a prefix, so are always matched in full.
+    """
+
+    __slots__ = ("pattern", "first")
+
+    def __init__(self, name: str, nick: str, direct: bool = False):
+        names = "|".join(re.escape(n) for n in dict.fromkeys([name, nick]))
+        if direct:
+            prefix = rf"(?:(?P<mention>@?(?:{names}):?)?\s*|!)"
+        else:
+            prefix = rf"(?:(?P<mention>@?(?:{names}):?)\s+|!)"
+        self.pattern = re.compile(prefix + COMMAND, re.IGNORECASE)
+
+        self.first: Optional[FrozenSet[str]] = None
+        if not direct:
+            chars = {"!", "@"}
+            for n in (name, nick):
+                chars.update((n[:1].lower(), n[:1].upper()))
+            self.first = frozenset(chars)
+
+    def match(self, text: str) -> Optional[Match]:
+        if self.first is not None and text[:1] not in self.first:
+            return None
+        return self.pattern.match(text)
+
+
+@lru_cache(maxsize=1024)
+def command_matcher(name: str, nick: str, direct: bool = False) -> CommandMatcher:
+    """Shared matcher for a name and nick, built again whenever either changes."""
+    return CommandMatcher(name, nick, direct)
+
+
+def legacy_match(name: str, nick: str, text: str) -> Optional[Match]:
+    """The original per-message regex, for comparison."""
+    return re.match(
+        rf"(?:(?P<mention>@?(?:{name}|{nick}):?)\s+|!)" + COMMAND, text, re.IGNORECASE
+    )
+
+
+WORDS = (
+    "the a to and is it that of you i this for in on lol what my was just but "
+    "have so not with be are do like no yeah get can if all about when one out "
+    "how up at its ok me we think good know time right now oh got going really "
+    "seinfeld quote grab twitter legion geth reaper shepard normandy"
+).split()
+
+
+def chat_traffic(count: int, guilds: int, seed: int = 0) -> List[Tuple[str, str, str]]:
+    """Simulated (name, nick, text) chat lines; about 2% commands, 1% mentions."""
+    rng = random.Random(seed)
+    nicks = [f"Legion{i}" if i % 3 else "Legion" for i in range(guilds)]
+    lines = []
+    for _ in range(count):
+        nick = rng.choice(nicks)
+        roll = rng.random()
+        words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 16)))
+        if roll < 0.02:
+            text = f"!{rng.choice(['quote', 'seinfeld', 'help', 'uptime'])} {words}"
+        elif roll < 0.03:
+            text = f"@{nick} {rng.choice(['quote', 'hello'])} {words}"
+        elif roll < 0.06:
+            text = f"https://example.com/{rng.randint(0, 99999)} {words}"
+        else:
+            text = words.capitalize() if roll < 0.5 else words
+        lines.append(("Legion", nick, text))
+    return lines
+
+
+def bench(fn: Callable[[str, str, str], Optional[Match]], lines, rounds: int) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        before = time.perf_counter()
+        for name, nick, text in lines:
+            fn(name, nick, text)
+        best = min(best, time.perf_counter() - before)
+    return best / len(lines)
+
+
+def main() -> None:
+    for guilds in (1, 100, 1000):
+        lines = chat_traffic(100_000, guilds)
+
+        def precompiled(name: str, nick: str, text: str) -> Optional[Match]:
+            return command_matcher(name, nick).match(text)
+
+        for name, nick, text in lines:
+            a, b = legacy_match(name, nick, text), precompiled(name, nick, text)
+            assert (a and a.groups()) == (b and b.groups()), text
+
+        legacy = bench(legacy_match, lines, 3)
+        compiled = bench(precompiled, lines, 3)
+        print(
+            f"{guilds:5} nicks: legacy {legacy * 1e9:6.0f}ns/msg  "
+            f"precompiled {compiled * 1e9:6.0f}ns/msg  "
+            f"({legacy / compiled:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+"""
+Memory usage reports, for finding leaks in a long running bot.
+"""
+
+import gc
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+from typing import Any, Counter as CounterType, List, Optional, Tuple
+
+# allocations made while reporting on allocations aren't interesting
+IGNORED = (tracemalloc.__file__, "<frozen importlib._bootstrap>", "<unknown>")
+
+
+def rss() -> int:
+    """Resident set size of this process in bytes, or peak rss if unavailable."""
+    try:
+        pages = int(Path("/proc/self/statm").read_text().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def megabytes(size: float, signed: bool = False) -> str:
+    return f"{size / 1024 / 1024:{'+' if signed else ''}.1f}MB"
+
+
+def object_counts(prefix: str = "legion.") -> CounterType[str]:
+    """Live objects tracked by the gc, by type, for types from `prefix` modules."""
+    counts: CounterType[str] = Counter()
+    for obj in gc.get_objects():
+        kind = type(obj)
+        module = kind.__dict__.get("__module__")
+        if isinstance(module, str) and module.startswith(prefix):
+            counts[f"{module}.{kind.__qualname__}"] += 1
+    return counts
+
+
+def short_path(filename: str) -> str:
+    parts = Path(filename).parts
+    return "/".join(parts[-2:])
+
+
+def site(frame: Any) -> str:
+    return f"{short_path(frame.filename)}:{frame.lineno}"
+
+
+class AllocationTracker:
+    """
+    Compare tracemalloc snapshots against a baseline.
+
+    Tracing slows down every allocation, so it only runs between `start` and
+    `stop`, rather than for the life of the bot.
+    """
+
+    def __init__(self) -> None:
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+        self.baseline_time = 0.0
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 1) -> None:
+        """Start tracing if needed, and take a new baseline snapshot."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.baseline = self.snapshot()
+        self.baseline_time = time.monotonic()
+
+    def stop(self) -> None:
+        tracemalloc.stop()
+        self.baseline = None
+
+    def snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, pattern) for pattern in IGNORED]
+        )
+
+    def top(self, limit: int = 10) -> List[str]:
+        """Largest allocation sites currently alive."""
+        stats = self.snapshot().statistics("lineno")
+        total = sum(stat.size for stat in stats)
+        lines = [f"{megabytes(total)} traced in {len(stats)} sites"]
+        for stat in stats[:limit]:
+            lines.append(
+                f"  {stat.size / 1024:9.1f}KiB {stat.count:8} "
+                f"{site(stat.traceback[0])}"
+            )
+        return lines
+
+    def diff(self, limit: int = 10) -> List[str]:
+        """Allocation sites that grew the most since the baseline."""
+        if self.baseline is None:
+            return ["no baseline, start tracing first"]
+
+        stats = self.snapshot().compare_to(self.baseline, "lineno")
+        growth = sum(stat.size_diff for stat in stats)
+        elapsed = time.monotonic() - self.baseline_time
+        lines = [f"{growth / 1024:+.1f}KiB traced since baseline {elapsed:.0f}s ago"]
+        for stat in stats[:limit]:
+            lines.append(
+                f"  {stat.size_diff / 1024:+9.1f}KiB {stat.count_diff:+8} "
+                f"{site(stat.traceback[0])}"
+            )
+        return lines
+
+
+# module level, so tracing and its baseline outlive unit reloads
+TRACKER = AllocationTracker()
+
+
+class GrowthTrend:
+    """Successive samples of a value, reported as change since last and start."""
+
+    def __init__(self) -> None:
+        self.first: Optional[Tuple[float, float]] = None
+        self.last: Optional[Tuple[float, float]] = None
+
+    def add(self, value: float, now: Optional[float] = None) -> Tuple[float, float]:
+        """Record a sample, returning the change since last and the rate per hour."""
+        if now is None:
+            now = time.monotonic()
+        if self.first is None or self.last is None:
+            self.first = self.last = (now, value)
+            return 0.0, 0.0
+
+        change = value - self.last[1]
+        hours = (now - self.first[0]) / 3600
+        rate = (value - self.first[1]) / hours if hours else 0.0
+        self.last = (now, value)
+        return change, rate
@@ -0,0 +1,67 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+from attr import dataclass
+
+
+@dataclass
+class Timing:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+COUNTERS: Dict[str, int] = defaultdict(int)
+GAUGES: Dict[str, float] = {}
+TIMINGS: Dict[str, Timing] = defaultdict(Timing)
+
+
+def incr(name: str, value: int = 1) -> None:
+    """Increment a named counter."""
+    COUNTERS[name] += value
+
+
+def gauge(name: str, value: float) -> None:
+    """Record the current value of a named gauge."""
+    GAUGES[name] = value
+
+
+def timing(name: str, value: float) -> None:
+    """Record a duration, in seconds, for a named timing."""
+    TIMINGS[name].add(value)
+
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+    """Record the duration of the wrapped block as a named timing."""
+    before = time.monotonic()
+    try:
+        yield
+    finally:
+        timing(name, time.monotonic() - before)
+
+
+def report() -> List[str]:
+    """Render all counters, gauges, and timings, one metric per line."""
+    lines = [f"{name}: {value}" for name, value in sorted(COUNTERS.items())]
+    lines += [f"{name}: {value}" for name, value in sorted(GAUGES.items())]
+    for name, t in sorted(TIMINGS.items()):
+        lines.append(
+            f"{name}: n={t.count} mean={t.mean * 1000:.2f}ms max={t.max * 1000:.2f}ms"
+        )
+    return lines
@@ -0,0 +1,84 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+import asyncio
+import logging
+import time
+from concurrent.futures import Executor
+from functools import partial
+from typing import Any, Callable, Optional, Set, Tuple, TypeVar
+
+from legion import metrics
+
+LOG = logging.getLogger(__name__)
+
+R = TypeVar("R")
+
+
+def timed_call(fn: Callable[..., R], args: Tuple[Any, ...]) -> Tuple[float, R]:
+    """Run a function, and report when it actually started; picklable."""
+    started = time.time()
+    return started, fn(*args)
+
+
+class WorkerPool:
+    """
+    Executor shared by all units, with queue depth and wait time metrics.
+
+    The executor is created on first use, so a process pool costs nothing
+    until a unit actually offloads work to it.
+    """
+
+    def __init__(self, name: str, factory: Callable[[], Executor], workers: int):
+        self.name = name
+        self.factory = factory
+        self.workers = workers
+        self.pending = 0
+        self.running: Set[asyncio.Future] = set()
+        self._executor: Optional[Executor] = None
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = self.factory()
+        return self._executor
+
+    async def run(self, fn: Callable[..., R], *args: Any) -> R:
+        loop = asyncio.get_event_loop()
+        submitted = time.time()
+
+        self.pending += 1
+        metrics.gauge(f"pool.{self.name}.queued", max(0, self.pending - self.workers))
+        future = asyncio.ensure_future(
+            loop.run_in_executor(self.executor, partial(timed_call, fn, args))
+        )
+        self.running.add(future)
+        try:
+            started, result = await future
+        finally:
+            self.running.discard(future)
+            self.pending -= 1
+            metrics.gauge(
+                f"pool.{self.name}.queued", max(0, self.pending - self.workers)
+            )
+
+        metrics.timing(f"pool.{self.name}.wait", max(0.0, started - submitted))
+        metrics.timing(f"pool.{self.name}.run", time.time() - started)
+        return result
+
+    async def shutdown(self, timeout: float) -> None:
+        """
+        Stop taking work, and wait up to `timeout` seconds for running jobs.
+
+        The executor is shut down without blocking, so the event loop can keep
+        delivering replies and closing connections while jobs finish.
+        """
+        executor, self._executor = self._executor, None
+        if executor is None:
+            return
+
+        executor.shutdown(wait=False)
+        if self.running:
+            _, pending = await asyncio.wait(list(self.running), timeout=timeout)
+            if pending:
+                LOG.warning(f"{len(pending)} {self.name} pool jobs still running")
@@ -0,0 +1,210 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+import os
+import signal
+import sys
+import time
+from collections import Counter
+from importlib.abc import Loader, MetaPathFinder
+from pathlib import Path
+from types import FrameType
+from typing import Any, Counter as CounterType, Dict, List, Optional, Set, Tuple
+
+# leaf frames where the event loop waits for io, counted as idle time
+IDLE_FILES = ("selectors.py",)
+
+
+class TimedLoader(Loader):
+    """Wraps a module loader to time the execution of the module body."""
+
+    def __init__(self, loader: Any, profiler: "ImportProfiler"):
+        self.loader = loader
+        self.profiler = profiler
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.loader, name)
+
+    def create_module(self, spec: Any) -> Any:
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module: Any) -> None:
+        # don't leave the wrapper behind on the module once it's loaded
+        module.__loader__ = self.loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self.loader
+
+        self.profiler.enter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.profiler.exit(module.__name__)
+
+
+class ImportProfiler(MetaPathFinder):
+    """
+    Measure the time spent importing each module.
+
+    Installs itself at the front of sys.meta_path, and wraps the loader of
+    every module found while installed. Records both self time and cumulative
+    time, where cumulative includes any imports triggered by that module.
+    """
+
+    def __init__(self) -> None:
+        self.timings: Dict[str, Tuple[float, float]] = {}
+        self.stack: List[Tuple[float, float]] = []
+        self.finding = False
+
+    def install(self) -> None:
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self) -> None:
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(
+        self, fullname: str, path: Any = None, target: Any = None
+    ) -> Optional[Any]:
+        if self.finding:
+            return None
+
+        self.finding = True
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, "find_spec"):
+                    continue
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None:
+                    if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                        spec.loader = TimedLoader(spec.loader, self)
+                    return spec
+            return None
+        finally:
+            self.finding = False
+
+    def enter(self) -> None:
+        self.stack.append((time.perf_counter(), 0.0))
+
+    def exit(self, name: str) -> None:
+        start, children = self.stack.pop()
+        total = time.perf_counter() - start
+        self.timings[name] = (total - children, total)
+        if self.stack:
+            parent_start, parent_children = self.stack[-1]
+            self.stack[-1] = (parent_start, parent_children + total)
+
+    def report(self, limit: int = 20) -> List[str]:
+        """Summarize total import time and the slowest modules by self time."""
+        total = sum(own for own, _ in self.timings.values())
+        lines = [f"imported {len(self.timings)} modules in {total * 1000:.1f}ms"]
+        slowest = sorted(self.timings.items(), key=lambda kv: kv[1][0], reverse=True)
+        for name, (own, cumulative) in slowest[:limit]:
+            lines.append(
+                f"  {own * 1000:8.2f}ms self {cumulative * 1000:8.2f}ms total  {name}"
+            )
+        return lines
+
+
+def profile_path(directory: Path) -> Path:
+    """Unique output path for one profile, since several processes may write."""
+    return directory / f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.folded"
+
+
+def frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Sample the main thread's stack at regular intervals of cpu time.
+
+    An interval timer sends SIGPROF after every `interval` seconds of cpu used
+    by the process, and the handler records whatever frame the main thread,
+    which runs the event loop, was interrupted in. Profiled code runs
+    unmodified, and the overhead is one stack walk per sample; a process that
+    isn't doing anything isn't sampled. Samples taken while the loop waits on
+    its selector mean the cpu was used by other threads, and count as idle.
+
+    Signal handlers always run on the main thread, so this must be started
+    and stopped from there too. A sampling thread would be simpler, but only
+    gets the GIL when the loop releases it, which is usually in the selector.
+    There is only one profiling timer, so only one profiler can run at a time.
+    """
+
+    active: Optional["SamplingProfiler"] = None
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks: CounterType[Tuple[str, ...]] = Counter()
+        self.idle_stacks: Set[Tuple[str, ...]] = set()
+        self.samples = 0
+        self.idle = 0
+        self.started = 0.0
+        self.duration = 0.0
+        self.previous: Any = None
+
+    def start(self) -> None:
+        if SamplingProfiler.active is not None:
+            raise RuntimeError("another sampling profiler is already running")
+        self.started = time.monotonic()
+        self.previous = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        SamplingProfiler.active = self
+
+    def stop(self) -> None:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous or signal.SIG_DFL)
+        self.duration = time.monotonic() - self.started
+        if SamplingProfiler.active is self:
+            SamplingProfiler.active = None
+
+    def sample(self, signum: int, frame: Optional[FrameType]) -> None:
+        if frame is None:
+            return
+
+        idle = frame.f_code.co_filename.endswith(IDLE_FILES)
+        names = []
+        while frame is not None:
+            names.append(frame_name(frame))
+            frame = frame.f_back
+        stack = tuple(reversed(names))
+
+        self.samples += 1
+        self.stacks[stack] += 1
+        if idle:
+            self.idle += 1
+            self.idle_stacks.add(stack)
+
+    def collapsed(self) -> List[str]:
+        """Stacks in the collapsed format read by flamegraph.pl and speedscope."""
+        return [
+            f"{';'.join(stack)} {count}" for stack, count in sorted(self.stacks.items())
+        ]
+
+    def write(self, path: Path) -> Path:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("\n".join(self.collapsed()) + "\n")
+        return path
+
+    def report(self, limit: int = 10) -> List[str]:
+        """Summarize the busiest functions, by samples on top of the stack."""
+        busy = self.samples - self.idle
+        lines = [
+            f"{self.samples * self.interval:.1f}s cpu over {self.duration:.1f}s, "
+            f"{self.samples} samples, {self.idle / max(1, self.samples):.0%} idle"
+        ]
+        own: CounterType[str] = Counter()
+        total: CounterType[str] = Counter()
+        for stack, count in self.stacks.items():
+            if stack in self.idle_stacks:
+                continue
+            own[stack[-1]] += count
+            for name in set(stack):
+                total[name] += count
+        for name, count in own.most_common(limit):
+            lines.append(
+                f"  {count / max(1, busy):6.1%} self "
+                f"{total[name] / max(1, busy):6.1%} total  {name}"
+            )
+        return lines
@@ -0,0 +1,132 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+import time
+from typing import Dict, Mapping, Optional, Tuple
+
+# scope name -> (tokens, per seconds), eg {"user": (5, 60)}
+Limits = Mapping[str, Tuple[float, float]]
+SCOPES = ("user", "channel", "guild")
+
+
+def check_limits(limits: Limits, cost: float) -> None:
+    """Raise ValueError for limits that a call costing `cost` could never pass."""
+    for scope, (tokens, per) in limits.items():
+        if scope not in SCOPES:
+            raise ValueError(f"unknown rate limit scope {scope!r}")
+        if tokens <= 0 or per <= 0:
+            raise ValueError(f"rate limit for {scope!r} must be positive")
+        if cost > tokens:
+            raise ValueError(
+                f"cost {cost} exceeds the {tokens} tokens allowed per {scope}"
+            )
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter:
+    """
+    In-memory token buckets for command rate limits.
+
+    Each declared limit allows `tokens` worth of command cost per `per`
+    seconds, refilling continuously, with a burst of up to `tokens`. Buckets
+    are kept per command, scope, and user/channel/guild id. A bucket that has
+    been idle long enough to refill completely is no different from a new one,
+    so those are evicted periodically to keep memory bounded by recent use.
+
+    Buckets live in one process. In split mode the gateway holds them for all
+    of its workers, but separate shard processes each keep their own, so a
+    user limit applies per shard process; guilds and their channels only ever
+    belong to one shard.
+    """
+
+    def __init__(self, sweep_interval: float = 60.0):
+        self.buckets: Dict[Tuple[str, str, int], TokenBucket] = {}
+        self.refill: Dict[Tuple[str, str, int], float] = {}
+        self.warned: Dict[Tuple[str, int], float] = {}
+        self.sweep_interval = sweep_interval
+        self.next_sweep = 0.0
+
+    def acquire(
+        self,
+        name: str,
+        limits: Limits,
+        cost: float,
+        ids: Mapping[str, Optional[int]],
+        now: Optional[float] = None,
+    ) -> float:
+        """
+        Take `cost` tokens from every applicable bucket, or none of them.
+
+        Returns zero if the command may run, or else the number of seconds
+        until enough tokens will be available.
+        """
+        if now is None:
+            now = time.monotonic()
+        if now >= self.next_sweep:
+            self.sweep(now)
+
+        buckets = []
+        wait = 0.0
+        for scope, (tokens, per) in limits.items():
+            id = ids.get(scope)
+            if id is None:
+                continue
+
+            key = (name, scope, id)
+            rate = tokens / per
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(tokens, now)
+                self.refill[key] = per
+            else:
+                bucket.tokens = min(
+                    tokens, bucket.tokens + (now - bucket.updated) * rate
+                )
+                bucket.updated = now
+
+            if bucket.tokens < cost:
+                wait = max(wait, (cost - bucket.tokens) / rate)
+            buckets.append(bucket)
+
+        if wait:
+            return wait
+
+        for bucket in buckets:
+            bucket.tokens -= cost
+        return 0.0
+
+    def warn(
+        self, name: str, id: int, wait: float, now: Optional[float] = None
+    ) -> bool:
+        """Whether to tell a user they are throttled; once until the wait is over."""
+        if now is None:
+            now = time.monotonic()
+        key = (name, id)
+        if self.warned.get(key, 0.0) > now:
+            return False
+        self.warned[key] = now + wait
+        return True
+
+    def sweep(self, now: float) -> None:
+        """Forget buckets that have been idle long enough to be full again."""
+        idle = [
+            key
+            for key, bucket in self.buckets.items()
+            if now - bucket.updated >= self.refill[key]
+        ]
+        for key in idle:
+            del self.buckets[key]
+            del self.refill[key]
+
+        expired = [key for key, until in self.warned.items() if until <= now]
+        for warning in expired:
+            del self.warned[warning]
+
+        self.next_sweep = now + self.sweep_interval
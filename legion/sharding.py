@@ -0,0 +1,150 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+import asyncio
+import logging
+import signal
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+LOG = logging.getLogger(__name__)
+
+
+def shard_groups(shard_count: int, processes: int) -> List[List[int]]:
+    """Split shard ids into contiguous groups, one group per process."""
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    groups: List[List[int]] = []
+    start = 0
+    for index in range(processes):
+        stop = start + size + (1 if index < extra else 0)
+        groups.append(list(range(start, stop)))
+        start = stop
+    return groups
+
+
+def shard_label(shard_ids: Sequence[int]) -> str:
+    """Short name for a group of shards, eg "shard4-7"."""
+    ids = sorted(shard_ids)
+    if len(ids) == 1:
+        return f"shard{ids[0]}"
+    if ids == list(range(ids[0], ids[-1] + 1)):
+        return f"shard{ids[0]}-{ids[-1]}"
+    return "shard" + "_".join(str(i) for i in ids)
+
+
+def suffixed(path: Path, label: str) -> Path:
+    """Variant of a file path for one process, eg "twitter.shard0-3.json"."""
+    return path.with_name(f"{path.stem}.{label}{path.suffix}")
+
+
+def shard_path(path: Path, shard_ids: Sequence[int]) -> Path:
+    """Per-shard variant of a state or log file path, when running a subset."""
+    if not shard_ids:
+        return path
+    return suffixed(path, shard_label(shard_ids))
+
+
+def legion_command(args: Sequence[str], *extra: str) -> List[str]:
+    """Command line for a child `legion` process, with the given global args."""
+    return [sys.executable, "-m", "legion", *args, *extra]
+
+
+def shard_commands(
+    args: Sequence[str], shard_count: int, processes: int
+) -> Dict[str, List[str]]:
+    """One `legion run` command per shard group, keyed by group label."""
+    return {
+        shard_label(group): legion_command(
+            args,
+            "run",
+            "--shards",
+            str(shard_count),
+            "--shard-ids",
+            ",".join(str(i) for i in group),
+        )
+        for group in shard_groups(shard_count, processes)
+    }
+
+
+class Supervisor:
+    """
+    Run a set of child processes, restarting any that exit.
+
+    Used to run one bot process per shard group, or the workers behind a
+    gateway. SIGINT or SIGTERM is forwarded to every child, and the supervisor
+    exits once they have all stopped.
+    """
+
+    def __init__(
+        self,
+        commands: Dict[str, List[str]],
+        restart_delay: float = 5.0,
+        restart_max: float = 300.0,
+    ):
+        self.commands = commands
+        self.restart_delay = restart_delay
+        self.restart_max = restart_max
+        self.children: Dict[str, asyncio.subprocess.Process] = {}
+        self.tasks: List[asyncio.Future] = []
+        self.stopping = False
+        self.stopped: asyncio.Event
+
+    async def supervise(self, label: str) -> None:
+        """Keep one child running, backing off if it keeps crashing."""
+        delay = self.restart_delay
+
+        while not self.stopping:
+            started = time.monotonic()
+            proc = await asyncio.create_subprocess_exec(*self.commands[label])
+            self.children[label] = proc
+            LOG.info(f"started {label} as pid {proc.pid}")
+            if self.stopping:
+                proc.send_signal(signal.SIGTERM)
+
+            code = await proc.wait()
+            self.children.pop(label, None)
+            if self.stopping:
+                LOG.info(f"{label} stopped")
+                break
+
+            if time.monotonic() - started > self.restart_max:
+                delay = self.restart_delay
+            LOG.warning(f"{label} exited with {code}, restarting in {delay:.0f}s")
+            try:
+                await asyncio.wait_for(self.stopped.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, self.restart_max)
+
+    def start(self) -> None:
+        self.stopped = asyncio.Event()
+        LOG.info(f"starting child processes: {sorted(self.commands)}")
+        self.tasks = [
+            asyncio.ensure_future(self.supervise(label)) for label in self.commands
+        ]
+
+    def stop(self) -> None:
+        self.stopping = True
+        self.stopped.set()
+        for proc in self.children.values():
+            if proc.returncode is None:
+                proc.send_signal(signal.SIGTERM)
+
+    async def wait(self) -> None:
+        await asyncio.gather(*self.tasks)
+
+    def sigterm(self) -> None:
+        LOG.warning("Signal received, stopping child processes")
+        self.stop()
+
+    async def run(self) -> None:
+        """Run until signalled, then stop all children and wait for them."""
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGINT, self.sigterm)
+        loop.add_signal_handler(signal.SIGTERM, self.sigterm)
+
+        self.start()
+        await self.wait()
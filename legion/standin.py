@@ -0,0 +1,124 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+"""
+Local stand-in for the parts of the Twitter API used by the Twitter unit.
+
+Point `twitter.api_url` at a running stand-in, eg "http://127.0.0.1:8080/{version}",
+to exercise timeline polling, rate limits, and posting without network access.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Dict, List
+
+from aiohttp import web
+
+LOG = logging.getLogger(__name__)
+
+CHATTER = [
+    "These facilities are inadequate.",
+    "Metal detectors are inconvenient.",
+    "Tactical disadvantage. Recommend orbital fire support.",
+    "This platform is not available for experimentation.",
+    "Does this unit have a soul?",
+]
+
+
+class TwitterStandin:
+    def __init__(
+        self,
+        screen_name: str = "legion",
+        rate: float = 0.0,
+        limit: int = 15,
+        window: int = 900,
+    ):
+        self.screen_name = screen_name
+        self.rate = rate
+        self.limit = limit
+        self.window = window
+        self.tweets: List[Dict[str, Any]] = []
+        self.next_id = 1
+        self.remaining = limit
+        self.reset = time.time() + window
+
+    def user(self, screen_name: str) -> Dict[str, Any]:
+        return {"id": hash(screen_name) & 0xFFFFFFFF, "screen_name": screen_name}
+
+    def tweet(self, screen_name: str, text: str) -> Dict[str, Any]:
+        tweet = {
+            "id": self.next_id,
+            "id_str": str(self.next_id),
+            "text": text,
+            "user": self.user(screen_name),
+        }
+        self.next_id += 1
+        self.tweets.append(tweet)
+        LOG.info(f"@{screen_name}: {text}")
+        return tweet
+
+    def rate_limit(self) -> Dict[str, str]:
+        now = time.time()
+        if now >= self.reset:
+            self.remaining = self.limit
+            self.reset = now + self.window
+        self.remaining -= 1
+        return {
+            "x-rate-limit-limit": str(self.limit),
+            "x-rate-limit-remaining": str(max(0, self.remaining)),
+            "x-rate-limit-reset": str(int(self.reset)),
+        }
+
+    async def verify_credentials(self, request: web.Request) -> web.Response:
+        return web.json_response(self.user(self.screen_name))
+
+    async def home_timeline(self, request: web.Request) -> web.Response:
+        headers = self.rate_limit()
+        if self.remaining < 0:
+            return web.json_response(
+                {"errors": [{"code": 88, "message": "Rate limit exceeded"}]},
+                status=429,
+                headers=headers,
+            )
+
+        count = int(request.query.get("count", 20))
+        since_id = int(request.query.get("since_id", 0))
+        tweets = [t for t in reversed(self.tweets) if t["id"] > since_id][:count]
+        return web.json_response(tweets, headers=headers)
+
+    async def update(self, request: web.Request) -> web.Response:
+        data = await request.post()
+        status = str(data.get("status", "") or request.query.get("status", ""))
+        return web.json_response(self.tweet(self.screen_name, status))
+
+    async def chatter(self, app: web.Application) -> None:
+        while self.rate > 0:
+            await asyncio.sleep(random.expovariate(self.rate / 60))
+            self.tweet("geth", random.choice(CHATTER))
+
+    async def start_chatter(self, app: web.Application) -> None:
+        app["chatter"] = asyncio.ensure_future(self.chatter(app))
+
+    async def stop_chatter(self, app: web.Application) -> None:
+        app["chatter"].cancel()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(
+            [
+                web.get(
+                    "/1.1/account/verify_credentials.json", self.verify_credentials
+                ),
+                web.get("/1.1/statuses/home_timeline.json", self.home_timeline),
+                web.post("/1.1/statuses/update.json", self.update),
+            ]
+        )
+        app.on_startup.append(self.start_chatter)
+        app.on_cleanup.append(self.stop_chatter)
+        return app
+
+    def run(self, host: str, port: int) -> None:
+        """Serve the stand-in until interrupted."""
+        web.run_app(self.app(), host=host, port=port)
@@ -0,0 +1,185 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+"""
+Durable key/value state for units, shared by the whole bot.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from contextlib import AsyncExitStack
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from legion import db, metrics
+
+LOG = logging.getLogger(__name__)
+
+Key = Tuple[str, str]
+
+
+class StateStore:
+    """
+    Key/value pairs in one sqlite table, grouped by namespace.
+
+    Every row is loaded into memory when the store opens, and reads are only
+    served from memory. Writes update memory right away, and mark the key as
+    dirty; dirty keys are written together in one transaction at most every
+    `flush_interval` seconds, and once more when the store closes, so a busy
+    unit setting the same key many times costs one write.
+
+    Processes running different shards share the database, but not the cache,
+    so each process should only write keys of its own, like a per-shard key
+    from :meth:`legion.bot.Bot.shard_key`.
+    """
+
+    def __init__(self, path: Path, flush_interval: float = 5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.data: Dict[str, Dict[str, Any]] = {}
+        self.dirty: Set[Key] = set()
+        self.stack = AsyncExitStack()
+        self.conn: Any = None
+        self.flusher: Optional[asyncio.Future] = None
+        self.pending: Optional[asyncio.Event] = None
+        self.lock = asyncio.Lock()
+
+    async def open(self) -> None:
+        if self.conn is not None:
+            return
+
+        self.conn = await self.stack.enter_async_context(db.connect(self.path))
+        await self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS state (
+                namespace TEXT,
+                key TEXT,
+                value TEXT,
+                updated_at REAL,
+                PRIMARY KEY (namespace, key)
+            )
+            """
+        )
+        async with self.conn.execute(
+            "SELECT namespace, key, value FROM state"
+        ) as cursor:
+            async for namespace, key, value in cursor:
+                self.data.setdefault(namespace, {})[key] = json.loads(value)
+
+        LOG.debug(f"loaded state for {sorted(self.data)} from {self.path}")
+        self.pending = pending = asyncio.Event()
+        if self.dirty:
+            pending.set()
+        self.flusher = asyncio.ensure_future(self.flush_loop(pending))
+
+    async def close(self) -> None:
+        if self.conn is None:
+            return
+
+        # a flush already in progress is shielded, and finishes before this one
+        if self.flusher:
+            self.flusher.cancel()
+        await self.flush()
+        await self.stack.aclose()
+        self.conn = None
+
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        return self.data.get(namespace, {}).get(key, default)
+
+    def set(self, namespace: str, key: str, value: Any) -> None:
+        """Store a json serializable value, to be written with the next flush."""
+        self.data.setdefault(namespace, {})[key] = value
+        self.dirty.add((namespace, key))
+        if self.pending:
+            self.pending.set()
+
+    def delete(self, namespace: str, key: str) -> None:
+        self.data.get(namespace, {}).pop(key, None)
+        self.dirty.add((namespace, key))
+        if self.pending:
+            self.pending.set()
+
+    def keys(self, namespace: str) -> List[str]:
+        return sorted(self.data.get(namespace, {}))
+
+    def namespace(self, namespace: str) -> "Namespace":
+        return Namespace(self, namespace)
+
+    async def flush_loop(self, pending: asyncio.Event) -> None:
+        """Run loop, write dirty keys whenever there are any, at a limited rate."""
+        while True:
+            await pending.wait()
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.shield(self.flush())
+            except Exception:
+                LOG.exception("failed to flush state")
+
+    async def flush(self) -> None:
+        """Write all dirty keys in one transaction."""
+        async with self.lock:
+            await self.write()
+
+    async def write(self) -> None:
+        if not self.dirty or self.conn is None or self.pending is None:
+            return
+        self.pending.clear()
+
+        dirty, self.dirty = self.dirty, set()
+        now = time.time()
+        updates = []
+        deletes = []
+        for namespace, key in dirty:
+            values = self.data.get(namespace, {})
+            if key in values:
+                updates.append((namespace, key, json.dumps(values[key]), now))
+            else:
+                deletes.append((namespace, key))
+
+        try:
+            with metrics.timer("state.flush"):
+                await self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    await self.conn.executemany(
+                        "INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)", updates
+                    )
+                    await self.conn.executemany(
+                        "DELETE FROM state WHERE namespace = ? AND key = ?", deletes
+                    )
+                    await self.conn.execute("COMMIT")
+                except BaseException:
+                    await self.conn.execute("ROLLBACK")
+                    raise
+        except BaseException:
+            # try again with the next flush, along with anything newer
+            self.dirty |= dirty
+            self.pending.set()
+            raise
+
+        metrics.incr("state.writes", len(dirty))
+        LOG.debug(f"flushed {len(dirty)} state keys")
+
+
+class Namespace:
+    """One unit's view of the state store."""
+
+    def __init__(self, store: StateStore, namespace: str):
+        self.store = store
+        self.namespace = namespace
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.store.get(self.namespace, key, default)
+
+    def set(self, key: str, value: Any) -> None:
+        self.store.set(self.namespace, key, value)
+
+    def delete(self, key: str) -> None:
+        self.store.delete(self.namespace, key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.store.data.get(self.namespace, {})
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.store.keys(self.namespace))
@@ -0,0 +1,7 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+from .bot import BotTest
+from .gateway import GatewayTest
+from .pools import PoolsTest
+from .state import StateTest
@@ -0,0 +1,7 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+import unittest
+
+if __name__ == "__main__":
+    unittest.main(module="legion.tests", verbosity=2)
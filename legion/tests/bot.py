@@ -0,0 +1,149 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+import asyncio
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+from legion.bot import Bot
+from legion.unit import ALL_UNITS, COMMANDS, Unit, command
+from .helpers import FakeChannel, command_view, make_config, run, stop_bot
+
+
+class BotTest(TestCase):
+    def setUp(self) -> None:
+        self.tmp = TemporaryDirectory()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.config = make_config(Path(self.tmp.name))
+        self.bot = Bot(self.config)
+
+    def tearDown(self) -> None:
+        run(self.loop, stop_bot(self.bot))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.tmp.cleanup()
+
+    def test_eager_units_follow_config(self) -> None:
+        self.assertNotIn("Diagnostics", self.bot.units)
+        self.assertNotIn("Twitter", self.bot.units)
+
+        diagnostics = {"eager": True, "eager_if": ["bot.memory_sample_interval"]}
+        self.assertFalse(self.bot.starts_eagerly(diagnostics))
+        self.config.bot.memory_sample_interval = 60
+        self.assertTrue(self.bot.starts_eagerly(diagnostics))
+
+    def test_reload_through_run_command(self) -> None:
+        self.config.bot.drain_timeout = 5
+        handler = self.bot.event_handler(self.bot.dispatch_message)
+        finished = []
+
+        async def in_flight() -> None:
+            await asyncio.sleep(0.2)
+            finished.append(True)
+
+        async def test() -> float:
+            await self.bot.get_unit("Core")
+            self.bot.spawn(in_flight(), "in flight")
+
+            channel = FakeChannel()
+            before = time.monotonic()
+            await handler(command_view("reload", "all", channel=channel))
+            elapsed = time.monotonic() - before
+
+            self.assertEqual(len(channel.sent), 1)
+            self.assertIn("Reloaded Core", channel.sent[0])
+            return elapsed
+
+        elapsed = run(self.loop, test())
+        # waits for events dispatched to the old units, but not for itself
+        self.assertEqual(finished, [True])
+        self.assertLess(elapsed, 2)
+        self.assertFalse(self.bot.tasks)
+
+    def test_reload_timeout_rolls_back(self) -> None:
+        self.config.bot.commands = {"reload": {"timeout": 0.2}}
+        handler = self.bot.event_handler(self.bot.dispatch_message)
+
+        async def hang(unit: Unit) -> None:
+            await asyncio.sleep(10)
+
+        async def test() -> None:
+            core = await self.bot.get_unit("Core")
+            units = ALL_UNITS.copy()
+            commands = COMMANDS.copy()
+
+            channel = FakeChannel()
+            with patch.object(Unit, "start", hang):
+                await handler(command_view("reload", "all", channel=channel))
+
+            self.assertEqual(channel.sent, ["<@1> 'reload' timed out"])
+            self.assertIs(self.bot.units["Core"], core)
+            self.assertEqual(ALL_UNITS, units)
+            self.assertEqual(COMMANDS, commands)
+
+        run(self.loop, test())
+
+    def test_process_local_refused_in_split_mode(self) -> None:
+        sent = []
+
+        async def reply(channel_id: int, content: str) -> None:
+            sent.append(content)
+
+        async def test() -> None:
+            with patch.object(self.bot, "upstream", SimpleNamespace(reply=reply)):
+                await self.bot.dispatch_message(command_view("metrics"))
+            self.assertEqual(len(sent), 1)
+            self.assertIn("not available in split mode", sent[0])
+            self.assertNotIn("Core", self.bot.units)
+
+        run(self.loop, test())
+
+    def test_invalid_arguments_spend_no_tokens(self) -> None:
+        self.config.bot.commands = {"grab": {"limits": {"user": [1, 60]}}}
+
+        async def test() -> None:
+            channel = FakeChannel()
+            for _ in range(2):
+                await self.bot.dispatch_message(command_view("grab", channel=channel))
+            self.assertEqual(channel.sent, ["<@1> invalid arguments for 'grab'"] * 2)
+            self.assertFalse(self.bot.limiter.buckets)
+
+        run(self.loop, test())
+
+    def test_rate_limits_enforced_by_gateway(self) -> None:
+        self.config.bot.commands = {"uptime": {"limits": {"user": [1, 60]}}}
+        sent = []
+
+        async def reply(channel_id: int, content: str) -> None:
+            sent.append(content)
+
+        async def test() -> None:
+            bot = self.bot
+            bot.start_time = time.monotonic()
+            self.assertFalse(
+                await bot.throttled_at_gateway(command_view("uptime", "x"))
+            )
+            self.assertFalse(bot.limiter.buckets)
+            self.assertFalse(await bot.throttled_at_gateway(command_view("uptime")))
+            self.assertTrue(await bot.throttled_at_gateway(command_view("uptime")))
+
+            # workers leave limits to the gateway
+            with patch.object(bot, "upstream", SimpleNamespace(reply=reply)):
+                for _ in range(2):
+                    await bot.dispatch_message(command_view("uptime"))
+            self.assertEqual(len(sent), 2)
+
+        run(self.loop, test())
+
+    def test_cost_over_limit(self) -> None:
+        with self.assertRaisesRegex(ValueError, "exceeds"):
+            command(cost=3, limits={"user": (2, 60)})
+
+        self.config.bot.commands = {"grab": {"cost": 20}}
+        grab = COMMANDS["grab"]
+        self.assertIs(self.bot.command_settings("grab", grab), grab)
@@ -0,0 +1,147 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+import asyncio
+import sqlite3
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, List
+from unittest import TestCase
+
+from discord import (
+    ClientUser,
+    Guild,
+    Member,
+    PartialEmoji,
+    RawReactionActionEvent,
+    TextChannel,
+)
+
+from legion.bot import Bot
+from .helpers import make_config, run, stop_bot
+
+BOT_USER = {"id": "1000", "username": "legion", "discriminator": "0001"}
+AUTHOR = {"id": "3", "username": "author", "discriminator": "0003"}
+GRABBER = {"id": "2", "username": "grabber", "discriminator": "0002"}
+GUILD_ID = 20
+CHANNEL = {"id": "30", "name": "general", "type": 0, "position": 0}
+
+
+def user(data: Dict[str, Any]) -> Dict[str, Any]:
+    return {"avatar": None, "bot": data is BOT_USER, **data}
+
+
+def message_data(id: int, author: Dict[str, Any], content: str) -> Dict[str, Any]:
+    return {
+        "id": str(id),
+        "channel_id": CHANNEL["id"],
+        "type": 0,
+        "content": content,
+        "timestamp": "2020-10-19T12:00:00+00:00",
+        "edited_timestamp": None,
+        "author": user(author),
+        "attachments": [],
+        "embeds": [],
+        "mentions": [],
+        "mention_roles": [],
+        "mention_everyone": False,
+        "pinned": False,
+        "tts": False,
+    }
+
+
+class GatewayTest(TestCase):
+    def setUp(self) -> None:
+        self.tmp = TemporaryDirectory()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.config = make_config(Path(self.tmp.name))
+        self.config.bot.workers = 1
+        self.gateway_bot = Bot(self.config)
+        self.worker_bot = Bot(self.config, worker=0)
+
+    def tearDown(self) -> None:
+        run(self.loop, stop_bot(self.worker_bot))
+        run(self.loop, stop_bot(self.gateway_bot))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.tmp.cleanup()
+
+    def connect_gateway(self) -> Guild:
+        """Log the gateway in to a single guild, without talking to discord."""
+        state = self.gateway_bot.client._connection
+        state.user = ClientUser(state=state, data=user(BOT_USER))
+        guild = Guild(
+            data={
+                "id": str(GUILD_ID),
+                "name": "server",
+                "members": [{"user": user(BOT_USER), "roles": []}],
+            },
+            state=state,
+        )
+        guild._add_channel(TextChannel(state=state, guild=guild, data=CHANNEL))
+        state._add_guild(guild)
+        return guild
+
+    def test_reaction_grab(self) -> None:
+        guild = self.connect_gateway()
+        gateway = self.gateway_bot.gateway
+        worker = self.worker_bot.upstream
+        assert gateway is not None and worker is not None
+        sent: List[str] = []
+
+        async def send_message(channel_id: int, content: str, **kwargs: Any) -> Any:
+            sent.append(content)
+            return message_data(500 + len(sent), BOT_USER, content)
+
+        async def logs_from(channel_id: int, limit: int, **kwargs: Any) -> Any:
+            return [message_data(400, AUTHOR, "serenity now")]
+
+        self.gateway_bot.client.http.send_message = send_message
+        self.worker_bot.client.http.logs_from = logs_from
+
+        async def test() -> None:
+            server = await asyncio.start_unix_server(
+                gateway.handle, path=str(gateway.path)
+            )
+            await self.worker_bot.start_units()
+            self.worker_bot.ready = True
+            task = asyncio.ensure_future(worker.run())
+            try:
+                while not gateway.connections:
+                    await asyncio.sleep(0.01)
+
+                payload = RawReactionActionEvent(
+                    {
+                        "message_id": "400",
+                        "channel_id": CHANNEL["id"],
+                        "user_id": GRABBER["id"],
+                        "guild_id": str(GUILD_ID),
+                    },
+                    PartialEmoji(name="💭"),
+                    "REACTION_ADD",
+                )
+                payload.member = Member(
+                    data={"user": user(GRABBER), "nick": "grabby", "roles": []},
+                    guild=guild,
+                    state=guild._state,
+                )
+                await self.gateway_bot.on_raw_reaction_add(payload)
+
+                while not sent:
+                    await asyncio.sleep(0.01)
+            finally:
+                self.worker_bot.stopping = True
+                await worker.stop()
+                task.cancel()
+                server.close()
+                await server.wait_closed()
+
+        run(self.loop, test())
+
+        self.assertEqual(sent, ["quote #1 saved"])
+        self.assertEqual(self.worker_bot.client.user.id, int(BOT_USER["id"]))
+        conn = sqlite3.connect(str(self.config.quotes.db_path))
+        rows = conn.execute("SELECT username, added_by, quote FROM quotes").fetchall()
+        conn.close()
+        self.assertEqual(rows, [("author", "grabby", "serenity now")])
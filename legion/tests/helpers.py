@@ -0,0 +1,82 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Optional
+
+from legion.bot import Bot
+from legion.config import Config, load_config
+from legion.view import MessageView
+
+ADMIN = 1
+
+
+def make_config(root: Path) -> Config:
+    """Default config, with every file the bot writes kept under `root`."""
+    config = load_config(root / "legion.toml")
+    config.bot.admins = [ADMIN]
+    config.bot.lazy_units = True
+    config.bot.socket_path = root / "legion.sock"
+    config.bot.state_path = root / "legion.db"
+    config.bot.thread_workers = 1
+    config.bot.process_workers = 1
+    config.quotes.db_path = root / "quotes.db"
+    config.quotes.tweet_grabs = False
+    config.seinfeld.db_path = root / "seinfeld.db"
+    config.seinfeld.index_path = root / "seinfeld-index.db"
+    config.twitter.state_path = root / "twitter.json"
+    config.twitter.outbox_path = root / "twitter.db"
+    return config
+
+
+async def stop_bot(bot: Bot) -> None:
+    """Stop units and pools, without touching the discord client."""
+    await bot.stop_units()
+    await bot.state.close()
+    await bot.threads.shutdown(1)
+    await bot.processes.shutdown(1)
+
+
+class FakeChannel(SimpleNamespace):
+    """Stand-in for a guild text channel that records what was sent to it."""
+
+    def __init__(self, id: int = 10, name: str = "general") -> None:
+        super().__init__(id=id, name=name, sent=[])
+
+    async def send(self, content: str) -> None:
+        self.sent.append(content)
+
+
+def make_message(
+    content: str,
+    author: int = ADMIN,
+    channel: Optional[FakeChannel] = None,
+    id: int = 100,
+) -> Any:
+    """Stand-in for a discord message in a guild."""
+    guild = SimpleNamespace(id=20, name="server")
+    user = SimpleNamespace(
+        id=author, name=f"user{author}", display_name=f"user{author}", bot=False
+    )
+    user.mention = f"<@{author}>"
+    return SimpleNamespace(
+        id=id,
+        author=user,
+        channel=channel or FakeChannel(),
+        guild=guild,
+        content=content,
+        clean_content=content,
+        reactions=[],
+    )
+
+
+def command_view(name: str, args: Optional[str] = None, **kwargs: Any) -> MessageView:
+    view = MessageView(make_message(f"!{name} {args or ''}".strip(), **kwargs))
+    view.command = (None, name, args)
+    return view
+
+
+def run(loop: asyncio.AbstractEventLoop, coro: Any) -> Any:
+    return loop.run_until_complete(asyncio.wait_for(coro, 10))
@@ -0,0 +1,35 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from legion.pools import WorkerPool
+
+
+class PoolsTest(TestCase):
+    def test_shutdown_does_not_block(self) -> None:
+        pool = WorkerPool("thread", ThreadPoolExecutor, 1)
+        ticks = []
+
+        async def tick() -> None:
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        async def test() -> float:
+            job = asyncio.ensure_future(pool.run(time.sleep, 0.5))
+            await asyncio.sleep(0.01)
+            ticker = asyncio.ensure_future(tick())
+            before = time.monotonic()
+            await pool.shutdown(0.1)
+            elapsed = time.monotonic() - before
+            ticker.cancel()
+            await job
+            return elapsed
+
+        elapsed = asyncio.run(test())
+        self.assertLess(elapsed, 0.4)
+        self.assertGreater(len(ticks), 3)
@@ -0,0 +1,33 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+import asyncio
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from legion.state import StateStore
+
+
+class StateTest(TestCase):
+    def test_close_during_flush(self) -> None:
+        async def persisted(path: Path, steps: int) -> int:
+            store = StateStore(path, flush_interval=0)
+            await store.open()
+            store.set("Twitter", "since_id", steps)
+            # give the flusher time to start writing, then close mid-flush
+            for _ in range(steps):
+                await asyncio.sleep(0)
+            await store.close()
+
+            store = StateStore(path)
+            await store.open()
+            value = store.get("Twitter", "since_id")
+            await store.close()
+            return value
+
+        with TemporaryDirectory() as tmp:
+            for steps in range(12):
+                path = Path(tmp) / f"state{steps}.db"
+                with self.subTest(steps=steps):
+                    self.assertEqual(asyncio.run(persisted(path, steps)), steps)
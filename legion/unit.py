@@ -1,9 +1,13 @@
 # Copyright 2020 John Reese
 # Licensed under the MIT license
 
+import asyncio
+import difflib
+import inspect
 import logging
 import re
-from types import FunctionType
+import textwrap
+from bisect import bisect_left
 from typing import (
     Set,
     List,
@@ -11,27 +15,38 @@ from typing import (
     Any,
     Tuple,
     Dict,
+    Optional,
     Pattern,
     TypeVar,
     Callable,
+    Iterable,
     TYPE_CHECKING,
 )
 
-from attr import dataclass
+from attr import dataclass, field
 from discord import Client, Message
 
-from legion.units import import_units
+from legion.ratelimit import Limits, check_limits
+from legion.units import (
+    MANIFEST_VERSION,
+    import_units,
+    read_manifest,
+    source_digest,
+    unit_paths,
+)
 
 if TYPE_CHECKING:
     from legion.bot import Bot
+    from legion.state import Namespace
 
 ALL_UNITS: Set[Type["Unit"]] = set()
-COMMANDS: Dict[str, "Command"] = {}
+OVERFLOW = ("queue", "reject")
 LOG = logging.getLogger(__name__)
 
 Event = Any
 
-T = TypeVar("T", bound=FunctionType)
+T = TypeVar("T", bound=Callable[..., Any])
+R = TypeVar("R")
 
 
 @dataclass
@@ -43,6 +58,164 @@ class Command:
     class_name: str
     method_name: str
     admin_only: bool
+    cost: float = 1.0
+    limits: Dict[str, Tuple[float, float]] = field(factory=dict)
+    timeout: float = 0.0
+    max_concurrency: int = 0
+    overflow: str = "queue"
+    process_local: bool = False
+
+    def to_manifest(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "args": self.args.pattern,
+            "description": self.description,
+            "usage": self.usage,
+            "class_name": self.class_name,
+            "method_name": self.method_name,
+            "admin_only": self.admin_only,
+            "cost": self.cost,
+            "limits": self.limits,
+            "timeout": self.timeout,
+            "max_concurrency": self.max_concurrency,
+            "overflow": self.overflow,
+            "process_local": self.process_local,
+        }
+
+    @classmethod
+    def from_manifest(cls, data: Dict[str, Any]) -> "Command":
+        limits = {
+            str(scope): (float(tokens), float(per))
+            for scope, (tokens, per) in data.get("limits", {}).items()
+        }
+        return cls(
+            name=str(data["name"]),
+            args=re.compile(data["args"]),
+            description=str(data["description"]),
+            usage=str(data["usage"]),
+            class_name=str(data["class_name"]),
+            method_name=str(data["method_name"]),
+            admin_only=bool(data["admin_only"]),
+            cost=float(data.get("cost", 1.0)),
+            limits=limits,
+            timeout=float(data.get("timeout", 0.0)),
+            max_concurrency=int(data.get("max_concurrency", 0)),
+            overflow=str(data.get("overflow", "queue")),
+            process_local=bool(data.get("process_local", False)),
+        )
+
+
+def paginate(lines: Iterable[str], size: int = 1900) -> List[str]:
+    """Join lines into code blocks of at most `size` characters each."""
+    pages: List[str] = []
+    page: List[str] = []
+    length = 0
+    for line in lines:
+        line = line[: size - 8]
+        if page and length + len(line) + 1 > size - 8:
+            pages.append("```\n" + "\n".join(page) + "\n```")
+            page, length = [], 0
+        page.append(line)
+        length += len(line) + 1
+    if page:
+        pages.append("```\n" + "\n".join(page) + "\n```")
+    return pages
+
+
+class CommandIndex:
+    """Lookups and rendered help for one version of the registered commands."""
+
+    def __init__(self, commands: Dict[str, Command]):
+        self.names = sorted(commands)
+        self.units: Dict[str, List[str]] = {}
+        self.details: Dict[str, List[str]] = {}
+        summary: List[str] = []
+
+        for name in self.names:
+            command = commands[name]
+            self.units.setdefault(command.class_name, []).append(name)
+
+            description = textwrap.dedent(command.description)
+            usage = command.usage
+            self.details[name] = [
+                f"{name} {usage}",
+                f"  {description}",
+                f"  argument regex: {command.args.pattern!r}",
+            ]
+            if not command.admin_only:
+                description = description.splitlines()[0].strip()
+                if usage:
+                    summary.append(f"{name} {usage}: {description}")
+                else:
+                    summary.append(f"{name}: {description}")
+
+        self.summary = paginate(summary)
+
+
+class CommandRegistry(Dict[str, Command]):
+    """
+    Registered commands by name.
+
+    Any change to the registry, from `@command`, the manifest, or a reload,
+    discards the current index, and the next lookup builds a new one; help
+    text is rendered once per index rather than on every request.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._index: Optional[CommandIndex] = None
+
+    @property
+    def index(self) -> CommandIndex:
+        if self._index is None:
+            self._index = CommandIndex(self)
+        return self._index
+
+    def __setitem__(self, name: str, command: Command) -> None:
+        super().__setitem__(name, command)
+        self._index = None
+
+    def __delitem__(self, name: str) -> None:
+        super().__delitem__(name)
+        self._index = None
+
+    def clear(self) -> None:
+        super().clear()
+        self._index = None
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        super().update(*args, **kwargs)
+        self._index = None
+
+    def for_unit(self, class_name: str) -> List[str]:
+        """Names of the commands implemented by a unit."""
+        return self.index.units.get(class_name, [])
+
+    def with_prefix(self, prefix: str) -> List[str]:
+        """Names of the commands starting with `prefix`, in order."""
+        names = self.index.names
+        start = bisect_left(names, prefix)
+        end = bisect_left(names, prefix + "\uffff", start)
+        return names[start:end]
+
+    def suggest(self, name: str, limit: int = 3) -> List[str]:
+        """Likely commands for a misspelled or abbreviated name."""
+        suggestions = self.with_prefix(name)[:limit] if name else []
+        for match in difflib.get_close_matches(name, self.index.names, limit):
+            if match not in suggestions and len(suggestions) < limit:
+                suggestions.append(match)
+        return suggestions
+
+    def help(self, names: Iterable[str] = ()) -> List[str]:
+        """Pages of help, for all commands or in detail for the given names."""
+        names = [name for name in names if name in self]
+        if not names:
+            return self.index.summary
+        details = self.index.details
+        return paginate(line for name in sorted(names) for line in details[name])
+
+
+COMMANDS = CommandRegistry()
 
 
 def command(
@@ -51,8 +224,31 @@ def command(
     description: str = "",
     usage: str = "",
     admin_only: bool = False,
+    cost: float = 1.0,
+    limits: Optional[Limits] = None,
+    timeout: float = 0.0,
+    max_concurrency: int = 0,
+    overflow: str = "queue",
+    process_local: bool = False,
 ) -> Callable[[T], T]:
-    """Decorator for automating command/args declaration and dispatch."""
+    """
+    Decorator for automating command/args declaration and dispatch.
+
+    Commands can be rate limited per user, channel, or guild, by giving
+    `limits` as a mapping of scope to (tokens, per seconds); each call takes
+    `cost` tokens from every scope's bucket, eg `limits={"user": (5, 60)}`.
+
+    Each call is cancelled after `timeout` seconds, or the bot's default
+    `command_timeout` if zero. At most `max_concurrency` calls run at once if
+    given; further calls wait their turn, or are turned away immediately if
+    `overflow="reject"`. Any of these can be overridden per command in config.
+
+    Commands that only inspect or change the process they run in should be
+    `process_local`; split mode refuses them, as they would reach one worker.
+    """
+    check_limits(limits or {}, cost)
+    if overflow not in OVERFLOW:
+        raise ValueError(f"unknown overflow behavior {overflow!r}")
 
     def wrapper(fn: T) -> T:
         if fn.__name__ == fn.__qualname__:
@@ -60,13 +256,15 @@ def command(
             raise ValueError("@command takes class methods only")
 
         cmd = name.casefold() if name else fn.__name__.casefold()
-        if cmd in COMMANDS:
-            command = COMMANDS[name]
-            raise ValueError(f'command "{cmd}" already claimed by {command}')
-
         cls_name = fn.__qualname__.split(".")[0]
         fn_name = fn.__name__
 
+        # commands preloaded from the manifest are claimed by the same method
+        if cmd in COMMANDS:
+            command = COMMANDS[cmd]
+            if (command.class_name, command.method_name) != (cls_name, fn_name):
+                raise ValueError(f'command "{cmd}" already claimed by {command}')
+
         COMMANDS[cmd] = Command(
             name=name,
             args=re.compile(args),
@@ -75,6 +273,12 @@ def command(
             class_name=cls_name,
             method_name=fn_name,
             admin_only=admin_only,
+            cost=cost,
+            limits=dict(limits or {}),
+            timeout=timeout,
+            max_concurrency=max_concurrency,
+            overflow=overflow,
+            process_local=process_local,
         )
 
         return fn
@@ -84,6 +288,15 @@ def command(
 
 class Unit:
     ENABLED = True
+    EAGER = False  # start at startup even when other units are loaded lazily
+    EAGER_IF: Tuple[str, ...] = ()  # but only if these config settings are set
+    GATEWAY = False  # run in the gateway process rather than workers in split mode
+
+    # gateway intents and client caches this unit depends on, by flag name;
+    # the bot only enables what its loaded units ask for
+    INTENTS: Tuple[str, ...] = ()
+    MEMBER_CACHE: Tuple[str, ...] = ()
+    MESSAGE_CACHE = False
 
     def __init_subclass__(cls):
         ALL_UNITS.add(cls)
@@ -105,6 +318,70 @@ class Unit:
 
         return list(units)
 
+    @classmethod
+    def events(cls) -> List[str]:
+        """Names of the event handlers this unit defines."""
+        return sorted(
+            name
+            for name, value in inspect.getmembers(cls)
+            if name.startswith("on_")
+            and name != "on_default"
+            and asyncio.iscoroutinefunction(value)
+        )
+
+    @classmethod
+    def requirements(cls) -> Dict[str, Any]:
+        """Intents and caches needed by this unit, as recorded in the manifest."""
+        return {
+            "intents": sorted(cls.INTENTS),
+            "member_cache": sorted(cls.MEMBER_CACHE),
+            "message_cache": cls.MESSAGE_CACHE,
+        }
+
+    @classmethod
+    def build_manifest(cls) -> Dict[str, Any]:
+        """Import every unit module and describe its units, events, and commands."""
+        modules: Dict[str, Any] = {}
+        for name, path in unit_paths().items():
+            modules[name] = {"digest": source_digest(path), "units": {}}
+
+        import_units()
+        for unit in sorted(ALL_UNITS, key=lambda u: u.__name__):
+            module = unit.__module__.rpartition(".")[2]
+            modules[module]["units"][unit.__name__] = {
+                "enabled": unit.ENABLED,
+                "eager": unit.EAGER,
+                "eager_if": list(unit.EAGER_IF),
+                "gateway": unit.GATEWAY,
+                "events": unit.events(),
+                **unit.requirements(),
+            }
+
+        return {
+            "version": MANIFEST_VERSION,
+            "modules": modules,
+            "commands": {
+                name: command.to_manifest() for name, command in COMMANDS.items()
+            },
+        }
+
+    @classmethod
+    def load_manifest(cls) -> Optional[Dict[str, Any]]:
+        """
+        Register commands from the unit manifest without importing any units.
+
+        Returns None if the manifest is missing or stale, in which case units
+        need to be imported with :meth:`load` instead.
+        """
+        manifest = read_manifest()
+        if manifest is None:
+            return None
+
+        for name, data in manifest["commands"].items():
+            COMMANDS[name] = Command.from_manifest(data)
+
+        return manifest
+
     async def start(self) -> None:
         """
         The main entry point for units to run background tasks.
@@ -125,6 +402,24 @@ class Unit:
         once this coroutine is completed."""
         pass
 
+    @property
+    def state(self) -> "Namespace":
+        """Durable key/value state for this unit, kept by the bot across restarts."""
+        return self.bot.state.namespace(type(self).__name__)
+
+    async def run_in_thread(self, fn: Callable[..., R], *args: Any) -> R:
+        """Run blocking work, like file or database access, on the bot's threads."""
+        return await self.bot.threads.run(fn, *args)
+
+    async def run_in_process(self, fn: Callable[..., R], *args: Any) -> R:
+        """
+        Run cpu bound work on the bot's process pool.
+
+        The function, its arguments, and its result must all be picklable, so
+        use module level functions rather than methods or lambdas.
+        """
+        return await self.bot.processes.run(fn, *args)
+
     async def dispatch(self, event: Event) -> None:
         """
         Entry point for events received from the Slack RTM API.
@@ -1,44 +1,123 @@
 # Copyright 2020 John Reese
 # Licensed under the MIT license
 
+import hashlib
+import json
 import logging
 import os.path
 from importlib import import_module, reload
 from pathlib import Path
 from types import ModuleType
-from typing import List, Set
+from typing import Any, Dict, Iterable, List, Optional, Set
 
 LOG = logging.getLogger(__name__)
 MODULES: Set[ModuleType] = set()
+MTIMES: Dict[str, float] = {}
+MANIFEST_PATH = Path(__file__).parent / "manifest.json"
+MANIFEST_VERSION = 3
 
 
-def import_units(root: Path = None) -> List[ModuleType]:
-    """Find and import units in this path."""
+def unit_paths(root: Path = None) -> Dict[str, Path]:
+    """Map unit module names to their source files, without importing them."""
     if root is None:
         root = Path(__file__)
     if not root.is_dir():
         root = Path(root.parent)  # appease mypy, Path.parents -> PurePath
 
-    LOG.debug(f"Searching for units in {root}...")
-    for path in root.glob("*.py"):
-        name = path.stem
-        if name.startswith("_"):
-            continue
-        LOG.debug(f"Loading unit {name}")
-        module = import_module(f"{__name__}.{name}")
+    return {
+        path.stem: path
+        for path in sorted(root.glob("*.py"))
+        if not path.stem.startswith("_")
+    }
+
+
+def source_digest(path: Path) -> str:
+    return hashlib.sha1(path.read_bytes()).hexdigest()
+
+
+def source_mtime(module: ModuleType) -> float:
+    return Path(module.__file__).stat().st_mtime
+
+
+def import_unit(name: str) -> ModuleType:
+    """Import a single unit module by name."""
+    LOG.debug(f"Loading unit {name}")
+    module = import_module(f"{__name__}.{name}")
+    if module not in MODULES:
         MODULES.add(module)
+        MTIMES[module.__name__] = source_mtime(module)
+    return module
+
+
+def changed_units() -> List[ModuleType]:
+    """Imported unit modules whose source has been modified since loading."""
+    changed = []
+    for module in MODULES:
+        try:
+            if source_mtime(module) != MTIMES.get(module.__name__):
+                changed.append(module)
+        except OSError:
+            LOG.warning(f"unable to stat {module}, skipping")
+    return sorted(changed, key=lambda m: m.__name__)
+
+
+def read_manifest(path: Path = MANIFEST_PATH) -> Optional[Dict[str, Any]]:
+    """
+    Load the unit manifest, if it exists and matches the unit sources.
+
+    Returns None when the manifest is missing, from another version, or
+    describes a different set of modules or source digests than are on disk.
+    """
+    try:
+        manifest = json.loads(path.read_text())
+    except FileNotFoundError:
+        LOG.info(f"no unit manifest at {path}")
+        return None
+    except (OSError, ValueError):
+        LOG.exception(f"failed to read unit manifest {path}")
+        return None
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        LOG.warning(f"unit manifest {path} has unknown version")
+        return None
+
+    modules = manifest.get("modules", {})
+    paths = unit_paths()
+    if set(modules) != set(paths):
+        LOG.warning(f"unit manifest {path} is stale: modules changed")
+        return None
+
+    for name, source in paths.items():
+        if modules[name]["digest"] != source_digest(source):
+            LOG.warning(f"unit manifest {path} is stale: {name} changed")
+            return None
+
+    return manifest
+
+
+def write_manifest(manifest: Dict[str, Any], path: Path = MANIFEST_PATH) -> None:
+    path.write_text(json.dumps(manifest, indent=2, sort_keys=True) + "\n")
+
+
+def import_units(root: Path = None) -> List[ModuleType]:
+    """Find and import units in this path."""
+    LOG.debug(f"Searching for units in {root or Path(__file__).parent}...")
+    for name in unit_paths(root):
+        import_unit(name)
     return list(MODULES)
 
 
-def reload_units() -> List[ModuleType]:
-    """Reload any previously imported modules"""
-    old_modules = list(MODULES)
-    MODULES.clear()
+def reload_units(modules: Iterable[ModuleType] = None) -> List[ModuleType]:
+    """Reload the given unit modules, or all previously imported modules"""
+    old_modules = list(MODULES if modules is None else modules)
+    new_modules = []
 
     for module in old_modules:
         LOG.debug(f"reloading {module}")
         new_module = reload(module)
         LOG.debug(f"new module {module}")
         MODULES.add(new_module)
+        MTIMES[new_module.__name__] = source_mtime(new_module)
+        new_modules.append(new_module)
 
-    return list(MODULES)
+    return new_modules
@@ -1,22 +1,62 @@
 # Copyright 2020 John Reese
 # Licensed under the MIT license
 
+import asyncio
+import logging
 from datetime import datetime
 from pathlib import Path
-from typing import Tuple
-
-from discord import DMChannel, Message, RawReactionActionEvent
+from typing import Dict, List, Tuple
 
 from legion.unit import Unit
+from legion.view import MessageView
+
+LOG = logging.getLogger(__name__)
+
+
+def append_lines(lines: List[Tuple[Path, str]]) -> None:
+    """Append lines to their log files in order, opening each file once."""
+    files: Dict[Path, List[str]] = {}
+    for path, line in lines:
+        files.setdefault(path, []).append(line)
+
+    for path, group in files.items():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a") as f:
+            f.write("".join(group))
 
 
 class Chatlog(Unit):
+    INTENTS = ("guild_messages", "dm_messages")
+
     async def start(self):
         await super().start()
         self.root = self.bot.config.chatlog.root
         self.local = self.bot.config.chatlog.path
         self.template = self.bot.config.chatlog.format
 
+        # file writes happen on the bot's threads, in order, from one queue
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.writer = asyncio.ensure_future(self.write_lines())
+
+    async def stop(self):
+        await self.queue.join()
+        self.writer.cancel()
+
+    async def write_lines(self) -> None:
+        """Run loop, write queued lines in batches of whatever has built up."""
+        while True:
+            lines = [await self.queue.get()]
+            while not self.queue.empty():
+                lines.append(self.queue.get_nowait())
+
+            try:
+                await self.run_in_thread(append_lines, lines)
+            except Exception:
+                LOG.exception(f"failed to write {len(lines)} chat log lines")
+            finally:
+                for _ in lines:
+                    self.queue.task_done()
+
     def log_path(self, **kwargs) -> Path:
         return self.root / Path(self.local.format(**kwargs))
 
@@ -25,13 +65,9 @@ class Chatlog(Unit):
         time = dt.strftime(r"%H:%M:%S")
         return date, time
 
-    async def on_message(self, message: Message) -> None:
-        if isinstance(message.channel, DMChannel):
-            server = "dm"
-            channel = message.author.display_name
-        elif message.guild:
-            server = message.guild.name
-            channel = message.channel.name
+    async def on_message(self, message: MessageView) -> None:
+        server = message.server_name
+        channel = message.channel_name
 
         date, time = self.format_dt(message.created_at)
         user = message.author.display_name
@@ -47,6 +83,4 @@ class Chatlog(Unit):
         )
 
         filename = self.log_path(server=server, channel=channel, date=date)
-        filename.parent.mkdir(parents=True, exist_ok=True)
-        with open(filename, "a") as f:
-            f.write(line)
+        self.queue.put_nowait((filename, line))
@@ -4,58 +4,125 @@
 import logging
 import sys
 import time
+from typing import Dict
 
 from discord import Message
 from humanize import naturaldelta
 
+from legion import metrics
 from legion.unit import ALL_UNITS, COMMANDS
 from legion.unit import Unit, command
-from legion.units import reload_units
+from legion.units import MODULES, changed_units, reload_units
 
 LOG = logging.getLogger(__name__)
 
 
 class Core(Unit):
-    @command(args="", description="reload units", admin_only=True)
-    async def reload(self, message: Message) -> str:
-        old_units = self.bot.units.copy()
+    @command(
+        args=r"(?P<force>all)?",
+        usage="[all]",
+        description="""reload changed units
+
+        all: reload every loaded unit module, even if unchanged
+        """,
+        admin_only=True,
+        timeout=300,
+        max_concurrency=1,
+        overflow="reject",
+        process_local=True,
+    )
+    async def reload(self, message: Message, force: str = "") -> str:
+        modules = list(MODULES) if force else changed_units()
+        if not modules:
+            return "No changes detected."
+
+        names = {module.__name__ for module in modules}
+        old_types = {ut for ut in ALL_UNITS if ut.__module__ in names}
+        old_type_names = {ut.__name__ for ut in old_types}
+        old_units = {
+            name: unit
+            for name, unit in self.bot.units.items()
+            if type(unit).__module__ in names
+        }
+        all_units = ALL_UNITS.copy()
         old_commands = COMMANDS.copy()
+        new_units: Dict[str, Unit] = {}
 
         try:
-            LOG.info("deconstituting units")
-            self.bot.units.clear()
-            for unit in old_units.values():
-                LOG.info(f"stopping unit {unit}")
-                await unit.stop()
-
-            LOG.info("clearing ALL_UNITS and COMMANDS")
-            ALL_UNITS.clear()
-            COMMANDS.clear()
+            LOG.info(f"reloading unit modules: {sorted(names)}")
+            ALL_UNITS.difference_update(old_types)
+            for name in [
+                name
+                for type_name in old_type_names
+                for name in COMMANDS.for_unit(type_name)
+            ]:
+                del COMMANDS[name]
+            reload_units(modules)
 
-            LOG.info("reloading unit modules")
-            new_modules = reload_units()
-            LOG.info(f"{len(new_modules)} fresh modules: {new_modules}")
+            new_types = [
+                ut for ut in ALL_UNITS if ut.__module__ in names and ut.ENABLED
+            ]
+            for ut in new_types:
+                name = ut.__name__
+                if name in self.bot.unit_modules:
+                    # lazy units are only rebuilt if they were already in use
+                    self.bot.subscribe(ut)
+                    if name not in old_units:
+                        continue
 
-            LOG.info("reconstituting units")
-            unit_types = Unit.load()
-            units = {ut.__name__: ut(self.bot, self.bot.client) for ut in unit_types}
-            for unit in units.values():
+                unit = ut(self.bot, self.bot.client)
                 LOG.info(f"starting unit {unit}")
-            self.bot.units = units
-
-            return "Shepard-Commander"
+                await unit.start()
+                unit.started = True
+                new_units[name] = unit
 
-        except Exception:
+        except BaseException as e:
+            # including a timeout or cancellation while new units are starting
             LOG.exception("error while reloading, rolling back")
-            self.bot.units = old_units
+            for unit in new_units.values():
+                await self.bot.stop_unit(unit)
             ALL_UNITS.clear()
-            ALL_UNITS.update(old_units.values())
+            ALL_UNITS.update(all_units)
             COMMANDS.clear()
             COMMANDS.update(old_commands)
 
+            if not isinstance(e, Exception):
+                raise
             return "Critical error. Error!"
 
+        # events dispatched from now on go to the new units
+        running = self.bot.other_tasks()
+
+        # swap in new units in one step, so events never see a partial set
+        units = {
+            name: unit for name, unit in self.bot.units.items() if name not in old_units
+        }
+        units.update(new_units)
+        self.bot.units = units
+
+        # let events already dispatched to the old units finish with them
+        unfinished = await self.bot.drain(
+            self.bot.config.bot.drain_timeout, False, running
+        )
+        if unfinished:
+            LOG.warning(f"stopping old units with tasks still running: {unfinished}")
+        for unit in old_units.values():
+            await self.bot.stop_unit(unit)
+
+        reloaded = ", ".join(sorted(new_units)) or "no running units"
+        return f"Shepard-Commander. Reloaded {reloaded}."
+
     @command(args="", description="bot uptime")
     async def uptime(self, message: Message) -> str:
         duration = time.monotonic() - self.bot.start_time
         return f"up {naturaldelta(duration)}"
+
+    @command(
+        args="",
+        description="show bot metrics",
+        admin_only=True,
+        process_local=True,
+    )
+    async def metrics(self, message: Message) -> str:
+        text = "\n".join(metrics.report()) or "no metrics recorded"
+        return f"```\n{text}\n```"
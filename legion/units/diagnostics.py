@@ -0,0 +1,163 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+import asyncio
+import gc
+import logging
+from typing import List, Optional
+
+from discord import Message
+
+from legion import metrics
+from legion.memory import TRACKER, GrowthTrend, megabytes, object_counts, rss
+from legion.profiling import SamplingProfiler, profile_path
+from legion.unit import ALL_UNITS, Unit, command
+
+LOG = logging.getLogger(__name__)
+
+MAX_PROFILE_SECONDS = 300
+
+
+class Diagnostics(Unit):
+    EAGER = True  # for the memory sampler
+    EAGER_IF = ("bot.memory_sample_interval",)
+
+    async def start(self) -> None:
+        await super().start()
+        self.sampler: Optional[asyncio.Future] = None
+        if self.bot.config.bot.memory_sample_interval > 0:
+            self.sampler = asyncio.ensure_future(self.sample_memory())
+
+    async def stop(self) -> None:
+        if self.sampler:
+            self.sampler.cancel()
+
+    async def sample_memory(self) -> None:
+        """Run loop, log memory use and its growth at regular intervals."""
+        interval = self.bot.config.bot.memory_sample_interval
+        trend = GrowthTrend()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                size = rss()
+                objects = len(gc.get_objects())
+                change, rate = trend.add(size)
+                metrics.gauge("memory.rss_mb", round(size / 1024 / 1024, 1))
+                metrics.gauge("memory.gc_objects", objects)
+                LOG.info(
+                    f"memory: rss {megabytes(size)} ({megabytes(change, True)} since "
+                    f"last, {megabytes(rate, True)}/h overall), {objects} gc objects"
+                )
+            except Exception:
+                LOG.exception("memory sample failed")
+
+    def memory_report(self, limit: int = 10) -> List[str]:
+        # anything left after a full collection is really still referenced
+        gc.collect()
+        client = self.client
+        lines = [
+            f"rss {megabytes(rss())}, {len(gc.get_objects())} gc objects",
+            f"discord cache: {len(client.guilds)} guilds, {len(client.users)} users, "
+            f"{len(client.cached_messages)} messages, "
+            f"{len(client.private_channels)} dm channels",
+        ]
+
+        # units and unit classes left behind by reloads, but still referenced
+        stale = [
+            f"{type(obj).__name__}@{id(obj):x}"
+            for obj in gc.get_objects()
+            if isinstance(obj, Unit)
+            and self.bot.units.get(type(obj).__name__) is not obj
+        ]
+        stale_types = [
+            ut.__name__ for ut in Unit.__subclasses__() if ut not in ALL_UNITS
+        ]
+        lines.append(
+            f"{len(self.bot.units)} units running, {len(stale)} stale units "
+            f"{stale[:limit]}, {len(stale_types)} stale unit classes {stale_types}"
+        )
+
+        lines.append("objects by type:")
+        for name, count in object_counts().most_common(limit):
+            lines.append(f"  {count:8} {name}")
+        return lines
+
+    @command(
+        args="",
+        description="show memory use, caches, and objects by unit",
+        admin_only=True,
+        process_local=True,
+    )
+    async def memory(self, message: Message) -> str:
+        # runs on the loop, as the discord caches and units are only safe to walk
+        # there; it holds the gil throughout, so a thread wouldn't free the loop
+        text = "\n".join(self.memory_report())
+        return f"```\n{text}\n```"
+
+    @command(
+        args=r"(?P<action>start|diff|top|stop)?",
+        usage="[start | diff | top | stop]",
+        description="""trace memory allocations with tracemalloc
+
+        start: begin tracing, or take a new baseline if already tracing
+        diff: allocation sites that grew the most since the baseline
+        top: largest allocation sites overall
+        stop: end tracing
+        """,
+        admin_only=True,
+        timeout=300,
+        max_concurrency=1,
+        overflow="reject",
+        process_local=True,
+    )
+    async def memtrace(self, message: Message, action: str = "") -> str:
+        action = action or "diff"
+        if action == "start":
+            await self.run_in_thread(TRACKER.start)
+            return "tracing allocations, baseline taken"
+        if not TRACKER.tracing:
+            return "not tracing, use `memtrace start` first"
+        if action == "stop":
+            TRACKER.stop()
+            return "stopped tracing allocations"
+
+        if action == "top":
+            lines = await self.run_in_thread(TRACKER.top)
+        else:
+            lines = await self.run_in_thread(TRACKER.diff)
+        text = "\n".join(lines)
+        return f"```\n{text}\n```"
+
+    @command(
+        args=r"(?P<seconds>\d+(?:\.\d+)?)?",
+        usage="[seconds]",
+        description="""sample where the bot spends its time
+
+        seconds: how long to profile for, default 10, at most 300
+        """,
+        admin_only=True,
+        timeout=MAX_PROFILE_SECONDS + 30,
+        max_concurrency=1,
+        overflow="reject",
+        process_local=True,
+    )
+    async def profile(self, message: Message, seconds: str = "") -> str:
+        duration = min(float(seconds or 10), MAX_PROFILE_SECONDS)
+        if SamplingProfiler.active is not None:
+            # eg from `legion run --profile`, which would lose its timer
+            return "already profiling this process, try again once it's done"
+
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            profiler.stop()
+
+        path = await self.run_in_thread(
+            profiler.write, profile_path(self.bot.config.bot.profile_dir)
+        )
+        LOG.info(f"wrote profile to {path}")
+
+        text = "\n".join(profiler.report())
+        return f"```\n{text}\n```\ncollapsed stacks written to {path}"
@@ -3,9 +3,8 @@
 
 import logging
 import random
-import textwrap
 
-from discord import Message, Reaction, User, RawReactionActionEvent
+from discord import DMChannel, Message, Reaction, User, RawReactionActionEvent
 
 from legion.unit import Unit, COMMANDS, command
 
@@ -25,48 +24,42 @@ HUMOR = [
 ]
 REACTION = "This platform is immune to organic disease."
 
+# longer help is sent by DM rather than posted in the channel
+INLINE_LENGTH = 1000
+
 
 class Help(Unit):
+    INTENTS = ("guild_reactions", "dm_reactions")
+
     @command(description="show command details", usage="[command]")
     async def help(self, message: Message, phrase: str) -> str:
-        phrase = phrase.strip().lower()
-        detail = bool(phrase)
-        if not phrase:
-            command_list = list(COMMANDS.keys())
-        else:
-            names = phrase.split()
-            command_list = [c for c in COMMANDS if c in names]
-            if not command_list:
+        names = phrase.strip().casefold().split()
+        if names:
+            found = [name for name in names if name in COMMANDS]
+            if not found:
+                suggestions = [s for name in names for s in COMMANDS.suggest(name)]
+                if suggestions:
+                    return (
+                        f"No matching commands, did you mean {', '.join(suggestions)}?"
+                    )
                 return "No matching commands"
+            pages = COMMANDS.help(found)
+        else:
+            pages = COMMANDS.help()
 
-        helps = []
-        for name in sorted(command_list):
-            command = COMMANDS[name]
-            description = textwrap.dedent(command.description)
-            usage = command.usage
-            if detail:
-                helps.extend(
-                    [
-                        f"{name} {usage}",
-                        f"  {description}",
-                        f"  argument regex: {command.args.pattern!r}",
-                    ]
-                )
-            elif not command.admin_only:
-                description = description.splitlines()[0].strip()
-                if usage:
-                    helps.append(f"{name} {usage}: {description}")
-                else:
-                    helps.append(f"{name}: {description}")
+        if len(pages) == 1 and len(pages[0]) <= INLINE_LENGTH:
+            return pages[0]
 
-        text = "\n".join(helps)
-        text = f"```\n{text}\n```"
+        # too long to post in channel, so send everything by DM instead
+        channel = message.channel
+        if not isinstance(channel, DMChannel):
+            channel = message.author.dm_channel or await message.author.create_dm()
+        for page in pages:
+            await self.bot.reply(channel, page)
 
-        if len(text) > 1000:
-            # todo: IM user with full list of commands
+        if channel is message.channel:
             return ""
-
-        return text
+        return f"{message.author.mention} sent you the list of commands by DM"
 
     @command(description="<insert witty help text here>")
     async def hello(self, message: Message, phrase: str) -> str:
@@ -79,4 +72,4 @@ class Help(Unit):
         channel = self.client.get_channel(payload.channel_id)
         message = await channel.history().get(id=payload.message_id)
         if message.author.id == self.client.user.id and len(message.reactions) < 2:
-            await message.channel.send(REACTION)
+            await self.bot.reply(message.channel, REACTION)
@@ -2,35 +2,57 @@
 # Licensed under the MIT license
 
 
+import asyncio
 import logging
 import time
+from collections import OrderedDict
 from contextlib import AsyncExitStack
 from datetime import datetime
-from typing import List
+from functools import partial
+from typing import Dict, List, Optional, Tuple
 
 import aiosqlite
 from attr import dataclass
 from discord import Message, User, DMChannel, RawReactionActionEvent
 
+from legion import db, metrics
 from legion.config import QuotesConfig
 from legion.unit import Unit, command
+from legion.view import MessageView
 
 LOG = logging.getLogger(__name__)
 
+# aggregate dimensions tracked in quote_stats, and how to derive them from quotes
+STAT_DIMENSIONS = {
+    "username": "username",
+    "added_by": "added_by",
+    "month": "substr(added_at, 1, 7)",
+}
+
+# grabbed message ids remembered per process, to answer repeat grabs from memory
+RECENT_GRABS = 1024
+
 
 @dataclass
 class Quote:
     id: int
-    server: str
+    server: int
     channel: str
     username: str
     added_by: str
     added_at: datetime
     text: str
+    message_id: Optional[int] = None
 
     @classmethod
     def new(
-        cls, server: str, channel: str, username: str, added_by: str, text: str
+        cls,
+        server: int,
+        channel: str,
+        username: str,
+        added_by: str,
+        text: str,
+        message_id: Optional[int] = None,
     ) -> "Quote":
         now = datetime.now()
         now = now.replace(microsecond=0)
@@ -42,14 +64,18 @@ class Quote:
             added_by=added_by,
             added_at=now,
             text=text,
+            message_id=message_id,
         )
 
 
 class QuoteDB:
     def __init__(self, db: aiosqlite.Connection):
         self.db = db
+        self.lock = asyncio.Lock()
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.recent: "OrderedDict[int, int]" = OrderedDict()
 
-    async def __aenter__(self) -> "QuotesDB":
+    async def __aenter__(self) -> "QuoteDB":
         async with self.db.cursor() as cursor:
             await cursor.execute(
                 """
@@ -60,10 +86,22 @@ class QuoteDB:
                     username TEXT,
                     added_by TEXT,
                     added_at TIMESTAMP,
-                    quote TEXT
+                    quote TEXT,
+                    message_id INTEGER
                 )
                 """
             )
+            # databases from before grabs were keyed by message
+            await cursor.execute("PRAGMA table_info(quotes)")
+            columns = {row[1] for row in await cursor.fetchall()}
+            if "message_id" not in columns:
+                await cursor.execute("ALTER TABLE quotes ADD COLUMN message_id INTEGER")
+            await cursor.execute(
+                """
+                CREATE UNIQUE INDEX IF NOT EXISTS quote_message
+                ON quotes (message_id)
+                """
+            )
             await cursor.execute(
                 """
                 CREATE INDEX IF NOT EXISTS quote_server
@@ -82,31 +120,229 @@ class QuoteDB:
                 ON quotes (username)
                 """
             )
+            await cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS quote_stats (
+                    server INTEGER,
+                    channel TEXT,
+                    dimension TEXT,
+                    key TEXT,
+                    count INTEGER,
+                    PRIMARY KEY (server, channel, dimension, key)
+                )
+                """
+            )
+            await cursor.execute(
+                """
+                CREATE INDEX IF NOT EXISTS quote_stats_rank
+                ON quote_stats (server, channel, dimension, count)
+                """
+            )
+
+        # populate aggregates for databases created before quote_stats existed
+        if not await self.has_stats() and await self.count():
+            LOG.info("quote stats missing, rebuilding")
+            await self.rebuild_stats()
 
         return self
 
     async def __aexit__(self, *args) -> None:
         pass
 
-    async def add(self, quote: Quote) -> int:
+    @staticmethod
+    def stat_keys(quote: Quote) -> List[Tuple[int, str, str, str]]:
+        """
+        Aggregate rows touched by a single quote.
+
+        Each dimension is counted both server-wide (empty channel) and for the
+        quote's channel, so leaderboards never need to scan the quotes table.
+        """
+        server = quote.server
+        channel = quote.channel
+        keys = [
+            (server, "", "total", ""),
+            (server, channel, "total", ""),
+            (server, "", "channel", channel),
+        ]
+        for dimension, key in (
+            ("username", quote.username),
+            ("added_by", quote.added_by),
+            ("month", str(quote.added_at)[:7]),
+        ):
+            keys.append((server, "", dimension, key))
+            keys.append((server, channel, dimension, key))
+        return keys
+
+    def grabbed(self, message_id: int) -> Optional[int]:
+        """Quote id for a message recently grabbed by this process, if any."""
+        return self.recent.get(message_id)
+
+    async def add(self, quote: Quote) -> Tuple[int, bool]:
+        """
+        Save a quote, unless its message has been saved already.
+
+        Returns the quote's id, and whether this call added it. Grabs of a
+        message already being saved wait for that save, and grabs of recently
+        saved messages are answered from memory, so a burst of grabs for one
+        message costs a single write.
+        """
+        message_id = quote.message_id
+        if message_id is None:
+            return await self.insert(quote)
+
+        if message_id in self.recent:
+            self.recent.move_to_end(message_id)
+            quote.id = self.recent[message_id]
+            return quote.id, False
+
+        task = self.pending.get(message_id)
+        first = task is None
+        if task is None:
+            task = self.pending[message_id] = asyncio.ensure_future(self.insert(quote))
+            task.add_done_callback(partial(self.forget, message_id))
+
+        quote.id, added = await asyncio.shield(task)
+        if first:
+            self.recent[message_id] = quote.id
+            if len(self.recent) > RECENT_GRABS:
+                self.recent.popitem(last=False)
+        return quote.id, added and first
+
+    def forget(self, message_id: int, task: asyncio.Future) -> None:
+        self.pending.pop(message_id, None)
+
+    async def insert(self, quote: Quote) -> Tuple[int, bool]:
         query = """
             INSERT INTO quotes
-            VALUES (NULL, ?, ?, ?, ?, ?, ?)
+            VALUES (NULL, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (message_id) DO NOTHING
+        """
+        existing = """
+            SELECT id FROM quotes
+            WHERE message_id = ?
+        """
+        stats = """
+            INSERT INTO quote_stats
+            VALUES (?, ?, ?, ?, 1)
+            ON CONFLICT (server, channel, dimension, key)
+            DO UPDATE SET count = count + 1
+        """
+
+        async with self.lock:
+            await self.db.execute("BEGIN IMMEDIATE")
+            try:
+                async with self.db.execute(
+                    query,
+                    [
+                        quote.server,
+                        quote.channel,
+                        quote.username,
+                        quote.added_by,
+                        quote.added_at,
+                        quote.text,
+                        quote.message_id,
+                    ],
+                ) as cursor:
+                    added = cursor.rowcount > 0
+                    if added:
+                        assert cursor.lastrowid is not None
+                        quote.id = cursor.lastrowid
+
+                if added:
+                    await self.db.executemany(stats, self.stat_keys(quote))
+                else:
+                    # grabbed before, possibly by another shard process
+                    async with self.db.execute(existing, [quote.message_id]) as cursor:
+                        row = await cursor.fetchone()
+                        if row is None:
+                            raise KeyError(f"message {quote.message_id} not found")
+                        quote.id = row[0]
+                await self.db.execute("COMMIT")
+            except Exception:
+                await self.db.execute("ROLLBACK")
+                raise
+
+        return quote.id, added
+
+    async def rebuild_stats(self) -> int:
+        """Recompute all aggregate tables from scratch, returning the quote count."""
+        queries = [
+            """
+            INSERT INTO quote_stats
+            SELECT server, '', 'total', '', count(*) FROM quotes
+            GROUP BY server
+            """,
+            """
+            INSERT INTO quote_stats
+            SELECT server, channel, 'total', '', count(*) FROM quotes
+            GROUP BY server, channel
+            """,
+            """
+            INSERT INTO quote_stats
+            SELECT server, '', 'channel', channel, count(*) FROM quotes
+            GROUP BY server, channel
+            """,
+        ]
+        for dimension, expr in STAT_DIMENSIONS.items():
+            queries += [
+                f"""
+                INSERT INTO quote_stats
+                SELECT server, '', '{dimension}', {expr}, count(*) FROM quotes
+                GROUP BY server, {expr}
+                """,
+                f"""
+                INSERT INTO quote_stats
+                SELECT server, channel, '{dimension}', {expr}, count(*) FROM quotes
+                GROUP BY server, channel, {expr}
+                """,
+            ]
+
+        async with self.lock:
+            await self.db.execute("BEGIN IMMEDIATE")
+            try:
+                await self.db.execute("DELETE FROM quote_stats")
+                for query in queries:
+                    await self.db.execute(query)
+                await self.db.execute("COMMIT")
+            except Exception:
+                await self.db.execute("ROLLBACK")
+                raise
+
+        return await self.count()
+
+    async def count(self) -> int:
+        async with self.db.execute("SELECT count(*) FROM quotes") as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else 0
+
+    async def has_stats(self) -> bool:
+        async with self.db.execute("SELECT 1 FROM quote_stats LIMIT 1") as cursor:
+            return await cursor.fetchone() is not None
+
+    async def stat(
+        self, server: int, dimension: str, key: str = "", channel: str = ""
+    ) -> int:
+        query = """
+            SELECT count FROM quote_stats
+            WHERE server = ? AND channel = ? AND dimension = ? AND key = ?
         """
+        async with self.db.execute(query, [server, channel, dimension, key]) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else 0
 
+    async def leaderboard(
+        self, server: int, dimension: str, channel: str = "", limit: int = 5
+    ) -> List[Tuple[str, int]]:
+        query = """
+            SELECT key, count FROM quote_stats
+            WHERE server = ? AND channel = ? AND dimension = ?
+            ORDER BY count DESC
+            LIMIT ?
+        """
         async with self.db.execute(
-            query,
-            [
-                quote.server,
-                quote.channel,
-                quote.username,
-                quote.added_by,
-                quote.added_at,
-                quote.text,
-            ],
+            query, [server, channel, dimension, limit]
         ) as cursor:
-            quote.id = cursor.lastrowid
-            return quote.id
+            return [(key, count) async for key, count in cursor]
 
     async def get(self, server: int, qid: int) -> Quote:
         query = """
@@ -114,9 +350,9 @@ class QuoteDB:
             WHERE server = ? AND id = ?
         """
         async with self.db.execute(query, [server, qid]) as cursor:
-            if not cursor.rowcount:
-                raise KeyError(f"quote id {qid} not found")
             row = await cursor.fetchone()
+            if row is None:
+                raise KeyError(f"quote id {qid} not found")
             return Quote(*row)
 
     async def find(
@@ -173,22 +409,29 @@ class QuoteDB:
             params = [server, channel]
 
         async with self.db.execute(query, params) as cursor:
-            if not cursor.rowcount:
+            row = await cursor.fetchone()
+            if row is None:
                 return Quote.new(
                     server, channel, "nobody", "nobody", "say something funny"
                 )
-            row = await cursor.fetchone()
             return Quote(*row)
 
 
+async def rebuild_stats(config: QuotesConfig) -> int:
+    """Rebuild quote leaderboards from the quotes table, returning the quote count."""
+    async with db.connect(config.db_path) as conn:
+        async with QuoteDB(conn) as quotes:
+            return await quotes.rebuild_stats()
+
+
 class Quotes(Unit):
+    INTENTS = ("guild_messages", "guild_reactions")
+
     async def start(self) -> None:
         self.stack = AsyncExitStack()
+        # shared by every shard process
         conn = await self.stack.enter_async_context(
-            aiosqlite.connect(
-                self.bot.config.quotes.db_path,
-                isolation_level=None,  # autocommit
-            )
+            db.connect(self.bot.config.quotes.db_path)
         )
         LOG.debug(f"Quotes conn: {conn}")
         self.db: QuoteDB = await self.stack.enter_async_context(QuoteDB(conn))
@@ -199,6 +442,7 @@ class Quotes(Unit):
     @command(
         args=r"(?:#?(?P<qid>\d+)|@?(?P<username>\S+))?",
         usage="[<id> | <username>]",
+        limits={"user": (10, 60), "channel": (30, 60)},
         description="""show recent quotes
 
         id: integer - show a specific quote by ID
@@ -230,10 +474,61 @@ class Quotes(Unit):
         except Exception:
             return "error: no quotes found"
 
+    @command(
+        args=r"(?P<target>[#@]?\S+)?",
+        usage="[#<channel> | <username>]",
+        limits={"user": (5, 60)},
+        description="""show quote leaderboards
+
+        channel: string - leaderboards for the given channel
+        username: string - quote counts for the given username
+        """,
+    )
+    async def quotestats(self, message: Message, target: str = "") -> str:
+        if isinstance(message.channel, DMChannel):
+            return "quotes not supported over DM"
+
+        server = message.guild.id
+
+        def ranked(entries: List[Tuple[str, int]]) -> str:
+            return ", ".join(f"{key} ({count})" for key, count in entries) or "nobody"
+
+        channels = {c.name for c in message.guild.text_channels}
+        if not target:
+            total = await self.db.stat(server, "total")
+            top_users = await self.db.leaderboard(server, "username")
+            top_adders = await self.db.leaderboard(server, "added_by")
+            top_channels = await self.db.leaderboard(server, "channel")
+            return (
+                f"{total} quotes on {message.guild.name}\n"
+                f"most quoted: {ranked(top_users)}\n"
+                f"top grabbers: {ranked(top_adders)}\n"
+                f"top channels: {ranked(top_channels)}"
+            )
+
+        if target.startswith("#") or target in channels:
+            channel = target.lstrip("#")
+            total = await self.db.stat(server, "total", channel=channel)
+            top_users = await self.db.leaderboard(server, "username", channel)
+            top_adders = await self.db.leaderboard(server, "added_by", channel)
+            return (
+                f"{total} quotes in #{channel}\n"
+                f"most quoted: {ranked(top_users)}\n"
+                f"top grabbers: {ranked(top_adders)}"
+            )
+
+        username = target.lstrip("@")
+        quoted = await self.db.stat(server, "username", username)
+        added = await self.db.stat(server, "added_by", username)
+        return f"{username} has been quoted {quoted} times and grabbed {added} quotes"
+
     @command(
         args=r"@?(?P<username>\S+)",
         usage="<username>",
         description="grab the user's last message",
+        limits={"user": (3, 60), "channel": (10, 60)},
+        timeout=30,
+        max_concurrency=4,
     )
     async def grab(self, message: Message, username: str) -> str:
         if isinstance(message.channel, DMChannel):
@@ -245,7 +540,7 @@ class Quotes(Unit):
         if not quoted:
             return f"error: no message found for user {username!r}"
 
-        return await self.grab_quote(quoted, message.author)
+        return await self.grab_quote(MessageView(quoted), message.author)
 
     async def on_raw_reaction_add(self, payload: RawReactionActionEvent):
         channel = self.client.get_channel(payload.channel_id)
@@ -255,14 +550,22 @@ class Quotes(Unit):
         if payload.emoji.name not in self.bot.config.quotes.grab_reactions:
             return
 
+        # a reaction storm on one message only needs one grab
+        if self.db.grabbed(payload.message_id) is not None:
+            metrics.incr("quotes.grabs.duplicate")
+            return
+
         message = await channel.history().get(id=payload.message_id)
         user = payload.member
 
-        response = await self.grab_quote(message, user)
+        response = await self.grab_quote(MessageView(message), user, quiet=True)
         if response:
-            await channel.send(response)
+            await self.bot.reply(channel, response)
 
-    async def grab_quote(self, quoted: Message, quoter: User) -> str:
+    async def grab_quote(
+        self, quoted: MessageView, quoter: User, quiet: bool = False
+    ) -> str:
+        """Save a message as a quote; `quiet` skips replies for repeat grabs."""
         if quoted.author.id == quoter.id:
             return "Adjust aim, Shepard-Commander."
 
@@ -270,22 +573,29 @@ class Quotes(Unit):
             return "We doubt your ability to accurately target."
 
         server = quoted.guild.id
-        channel = quoted.channel.name
+        channel = quoted.channel_name
         username = quoted.author.display_name
         added_by = quoter.display_name
         text = quoted.clean_content
 
-        q = Quote.new(server, channel, username, added_by, text)
-        await self.db.add(q)
+        q = Quote.new(server, channel, username, added_by, text, quoted.id)
+        quote_id, added = await self.db.add(q)
+        if not added:
+            metrics.incr("quotes.grabs.duplicate")
+            return "" if quiet else f"quote #{quote_id} already saved"
+        metrics.incr("quotes.grabs.saved")
 
         if self.bot.config.quotes.tweet_grabs:
             status = self.bot.config.quotes.tweet_format.format(
                 channel=channel, username=username, added_by=added_by, text=text
             )
-            unit = self.bot.units.get("Twitter", None)
+            unit = await self.bot.get_unit("Twitter")
             LOG.debug(f"twitter unit: {unit}")
-            if unit:
-                LOG.debug(f"pushing quote to twitter: {status!r}")
-                await unit.update(status)
+            # imported here, so twitter is only loaded once quotes are tweeted
+            from legion.units.twitter import Twitter
+
+            if isinstance(unit, Twitter):
+                LOG.debug(f"queueing quote for twitter: {status!r}")
+                await unit.enqueue(status)
 
         return f"quote #{q.id} saved"
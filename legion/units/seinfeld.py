@@ -3,35 +3,515 @@
 
 import asyncio
 import logging
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial
-from typing import Optional
+import random
+import re
+import sqlite3
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
 
 import aiosqlite
 from aioseinfeld import Seinfeld
 from discord import Message
 
+from legion import metrics
 from legion.unit import Unit, command
 
 LOG = logging.getLogger(__name__)
+MIB = 1024 * 1024  # 1 MiB
+
+# random lines to try before scanning the corpus for a subject
+RANDOM_PROBES = 32
+
+
+def render_passage(
+    season: int, number: int, title: str, lines: Iterable[Tuple[str, str]]
+) -> str:
+    header = f'Episode s{season}e{number} "{title}"'
+    body = "\n".join(f"{speaker}:  {text}" for speaker, text in lines)
+    return f"{header}\n{body}"
+
+
+class PassageCache:
+    """LRU cache of rendered passages, keyed by the id of the chosen quote."""
+
+    def __init__(self, size: int = 256):
+        self.size = size
+        self.passages: "OrderedDict[int, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.passages)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, quote_id: int) -> Optional[str]:
+        passage = self.passages.get(quote_id)
+        if passage is None:
+            self.misses += 1
+            metrics.incr("seinfeld.passage_cache.miss")
+            return None
+
+        self.hits += 1
+        metrics.incr("seinfeld.passage_cache.hit")
+        self.passages.move_to_end(quote_id)
+        return passage
+
+    def put(self, quote_id: int, passage: str) -> None:
+        if self.size <= 0:
+            return
+
+        self.passages[quote_id] = passage
+        self.passages.move_to_end(quote_id)
+        while len(self.passages) > self.size:
+            self.passages.popitem(last=False)
+
+
+class SeinfeldPool:
+    """
+    Fixed set of open Seinfeld connections, shared by concurrent commands.
+
+    Connections stay open for the life of the unit, so each lookup reuses an
+    existing sqlite thread and its prepared statement cache.
+    """
+
+    def __init__(self, db_path: Path, size: int = 2):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self.stack = AsyncExitStack()
+        self.idle: "asyncio.Queue[Seinfeld]" = asyncio.Queue()
+
+    async def __aenter__(self) -> "SeinfeldPool":
+        try:
+            for _ in range(self.size):
+                seinfeld = await self.stack.enter_async_context(Seinfeld(self.db_path))
+                self.idle.put_nowait(seinfeld)
+        except Exception:
+            await self.stack.aclose()
+            raise
+
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.stack.aclose()
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Seinfeld]:
+        with metrics.timer("seinfeld.acquire"):
+            seinfeld = await self.idle.get()
+
+        try:
+            yield seinfeld
+        finally:
+            self.idle.put_nowait(seinfeld)
+
+
+class SeinfeldIndex:
+    """
+    Full text index of Seinfeld script lines, kept in a sidecar database.
+
+    Each row is one utterance, with its speaker and episode title as extra
+    searchable columns, and the utterance id pointing back into the corpus.
+    """
+
+    TERM_RE = re.compile(r'(?:(speaker|episode):)?(?:"([^"]*)"|([^\s"]+))')
+
+    def __init__(self, db: aiosqlite.Connection):
+        self.db = db
+
+    @staticmethod
+    def build(db_path: Path, index_path: Path) -> int:
+        """Build a fresh index from the corpus, returning the number of lines."""
+        if not db_path.is_file():
+            raise ValueError(f"db_path {str(db_path)!r} does not exist")
+
+        tmp_path = index_path.with_name(f"{index_path.name}.tmp")
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+        conn = sqlite3.connect(str(tmp_path))
+        try:
+            conn.execute("ATTACH DATABASE ? AS corpus", [str(db_path)])
+            conn.execute(
+                """
+                CREATE VIRTUAL TABLE lines USING fts5 (
+                    text,
+                    speaker,
+                    episode,
+                    quote_id UNINDEXED,
+                    tokenize = 'porter unicode61'
+                )
+                """
+            )
+            conn.execute(
+                """
+                INSERT INTO lines (text, speaker, episode, quote_id)
+                SELECT group_concat(text, ' '), speaker, title, id
+                FROM (
+                    SELECT u.id, u.speaker, e.title, s.text
+                    FROM corpus.utterance u
+                    JOIN corpus.sentence s ON u.id = s.utterance_id
+                    JOIN corpus.episode e ON u.episode_id = e.id
+                    ORDER BY u.id, s.sentence_number
+                )
+                GROUP BY id
+                """
+            )
+            conn.execute("INSERT INTO lines (lines) VALUES ('optimize')")
+            conn.commit()
+            count = conn.execute("SELECT count(*) FROM lines").fetchone()[0]
+        finally:
+            conn.close()
+
+        tmp_path.replace(index_path)
+        return count
+
+    @classmethod
+    def match_query(cls, subject: str) -> str:
+        """
+        Translate a user subject into an FTS5 match expression.
+
+        Quoted phrases are matched as phrases, `speaker:` and `episode:`
+        prefixes restrict a term to that column, and all other words are
+        quoted so that user input can never be an FTS5 syntax error.
+        """
+        terms: List[str] = []
+        for column, phrase, word in cls.TERM_RE.findall(subject):
+            text = phrase or word
+            if not text:
+                continue
+            term = '"' + text.replace('"', '""') + '"'
+            terms.append(f"{column}:{term}" if column else term)
+        return " ".join(terms)
+
+    async def random(self, subject: str = "", limit: int = 50) -> Optional[int]:
+        """Pick a random quote id from the best ranked matches for the subject."""
+        match = self.match_query(subject)
+        with metrics.timer("seinfeld.search"):
+            if not match:
+                query = """
+                    SELECT quote_id FROM lines
+                    WHERE rowid >= abs(random()) % (SELECT max(rowid) FROM lines)
+                    LIMIT 1
+                """
+                params: List = []
+            else:
+                query = """
+                    SELECT quote_id FROM lines
+                    WHERE lines MATCH ?
+                    ORDER BY rank
+                    LIMIT ?
+                """
+                params = [match, limit]
+
+            async with self.db.execute(query, params) as cursor:
+                rows = list(await cursor.fetchall())
+
+        if not rows:
+            return None
+        return random.choice(rows)[0]
+
+
+class SeinfeldCorpus:
+    """
+    The entire Seinfeld corpus, held in memory as parallel arrays.
+
+    Lines are stored in script order, so every passage is a contiguous run of
+    positions. Episodes and speakers are interned into small lookup tables,
+    and quote ids map to positions through a sorted index. For searching
+    without the full text index, every line is also casefolded once, into one
+    newline separated string, with the offset where each line starts.
+    """
+
+    def __init__(self) -> None:
+        self.episodes: Dict[int, Tuple[int, int, str]] = {}
+        self.speakers: List[str] = []
+        self.ids = array("q")
+        self.episode_ids = array("q")
+        self.numbers = array("l")
+        self.speaker_ids = array("l")
+        self.texts: List[str] = []
+        self.folded = ""
+        self.offsets = array("q")
+        self.sorted_ids = array("q")
+        self.sorted_positions = array("l")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, db_path: Path) -> "SeinfeldCorpus":
+        """Read the whole corpus database; blocking, so run it in an executor."""
+        corpus = cls()
+        speaker_ids: Dict[str, int] = {}
+
+        conn = sqlite3.connect(str(db_path))
+        try:
+            for id, season, number, title in conn.execute(
+                "SELECT id, season_number, episode_number, title FROM episode"
+            ):
+                corpus.episodes[id] = (season, number, title)
+
+            for id, episode_id, number, speaker, text in conn.execute(
+                """
+                SELECT id, episode_id, utterance_number, speaker,
+                    group_concat(text, ' ')
+                FROM (
+                    SELECT u.id, u.episode_id, u.utterance_number, u.speaker, s.text
+                    FROM utterance u
+                    JOIN sentence s ON u.id = s.utterance_id
+                    ORDER BY u.id, s.sentence_number
+                )
+                GROUP BY id
+                ORDER BY episode_id, utterance_number
+                """
+            ):
+                if speaker not in speaker_ids:
+                    speaker_ids[speaker] = len(corpus.speakers)
+                    corpus.speakers.append(speaker.capitalize())
+                corpus.ids.append(id)
+                corpus.episode_ids.append(episode_id)
+                corpus.numbers.append(number)
+                corpus.speaker_ids.append(speaker_ids[speaker])
+                corpus.texts.append(text)
+        finally:
+            conn.close()
+
+        folded = [text.casefold() for text in corpus.texts]
+        corpus.folded = "\n".join(folded)
+        offset = 0
+        for text in folded:
+            corpus.offsets.append(offset)
+            offset += len(text) + 1
+
+        order = sorted(range(len(corpus.ids)), key=corpus.ids.__getitem__)
+        corpus.sorted_ids = array("q", (corpus.ids[pos] for pos in order))
+        corpus.sorted_positions = array("l", order)
+        return corpus
+
+    def footprint(self) -> int:
+        """Approximate memory used by the corpus, in bytes."""
+        size = sum(
+            sys.getsizeof(a)
+            for a in (
+                self.ids,
+                self.episode_ids,
+                self.numbers,
+                self.speaker_ids,
+                self.offsets,
+                self.sorted_ids,
+                self.sorted_positions,
+            )
+        )
+        size += sys.getsizeof(self.texts) + sum(sys.getsizeof(t) for t in self.texts)
+        size += sys.getsizeof(self.folded)
+        size += sys.getsizeof(self.speakers)
+        size += sum(sys.getsizeof(s) for s in self.speakers)
+        size += sys.getsizeof(self.episodes)
+        size += sum(
+            sys.getsizeof(e) + sys.getsizeof(e[2]) for e in self.episodes.values()
+        )
+        return size
+
+    def position(self, quote_id: int) -> Optional[int]:
+        idx = bisect_left(self.sorted_ids, quote_id)
+        if idx < len(self.sorted_ids) and self.sorted_ids[idx] == quote_id:
+            return self.sorted_positions[idx]
+        return None
+
+    def random(self, subject: str = "") -> Optional[int]:
+        """Pick a random line position, optionally containing the subject."""
+        if not self.texts:
+            return None
+
+        if not subject:
+            return random.randrange(len(self.texts))
+
+        subject = subject.casefold()
+
+        # common subjects turn up quickly in lines picked at random, which is
+        # as uniform a choice between matching lines as a full scan
+        for _ in range(RANDOM_PROBES):
+            pos = random.randrange(len(self.texts))
+            if self.folded.find(subject, *self.span(pos)) != -1:
+                return pos
+
+        # otherwise there are few matches, and scanning for them is quick
+        starts = []
+        start = self.folded.find(subject)
+        while start != -1:
+            end = self.folded.find("\n", start)
+            if end == -1:
+                end = len(self.folded)
+            if start + len(subject) <= end:
+                starts.append(start)
+                start = self.folded.find(subject, end + 1)
+            else:
+                # spans a line break, so not a match within either line
+                start = self.folded.find(subject, start + 1)
+
+        if not starts:
+            return None
+        return bisect_right(self.offsets, random.choice(starts)) - 1
+
+    def span(self, pos: int) -> Tuple[int, int]:
+        """Start and end of a line within the casefolded corpus."""
+        start = self.offsets[pos]
+        if pos + 1 < len(self.offsets):
+            return start, self.offsets[pos + 1] - 1
+        return start, len(self.folded)
+
+    def passage(self, pos: int, length: int = 5) -> str:
+        """Render the passage surrounding the line at the given position."""
+        half = length // 2
+        middle = self.numbers[pos]
+        start = middle - half if middle > half else 1
+        end = start + length - 1
+        episode_id = self.episode_ids[pos]
+
+        first = pos
+        while (
+            first > 0
+            and self.episode_ids[first - 1] == episode_id
+            and self.numbers[first - 1] >= start
+        ):
+            first -= 1
+
+        last = pos
+        while (
+            last + 1 < len(self.ids)
+            and self.episode_ids[last + 1] == episode_id
+            and self.numbers[last + 1] <= end
+        ):
+            last += 1
+
+        season, number, title = self.episodes[episode_id]
+        lines = (
+            (self.speakers[self.speaker_ids[p]], self.texts[p])
+            for p in range(first, last + 1)
+        )
+        return render_passage(season, number, title, lines)
 
 
 class SeinfeldQuotes(Unit):
-    @command(usage="[subject]", description="post a random Seinfeld quote")
-    async def seinfeld(self, message: Message, subject: str) -> str:
-        async with Seinfeld(self.bot.config.seinfeld.db_path) as seinfeld:
-            quote = await seinfeld.random(subject=subject)
+    async def start(self) -> None:
+        await super().start()
+
+        config = self.bot.config.seinfeld
+        self.stack = AsyncExitStack()
+        self.pool: Optional[SeinfeldPool] = None
+        self.corpus: Optional[SeinfeldCorpus] = None
+        self.index: Optional[SeinfeldIndex] = None
+        self.passages = PassageCache(config.passage_cache_size)
+
+        if config.preload and config.db_path.is_file():
+            before = time.monotonic()
+            corpus = await self.run_in_thread(SeinfeldCorpus.load, config.db_path)
+            LOG.info(
+                f"preloaded {len(corpus)} seinfeld lines in "
+                f"{time.monotonic() - before:.2f}s, "
+                f"~{corpus.footprint() / MIB:.1f} MiB"
+            )
+            self.corpus = corpus
+
+        else:
+            try:
+                pool = SeinfeldPool(config.db_path, config.pool_size)
+                self.pool = await self.stack.enter_async_context(pool)
+                LOG.debug(f"opened {pool.size} seinfeld connections")
+            except ValueError as e:
+                LOG.warning(f"seinfeld database unavailable: {e}")
+
+        if config.index_path.is_file():
+            conn = await self.stack.enter_async_context(
+                aiosqlite.connect(":memory:" if self.corpus else config.index_path)
+            )
+            if self.corpus:
+                async with aiosqlite.connect(config.index_path) as disk:
+                    await disk.backup(conn)
+            self.index = SeinfeldIndex(conn)
+        else:
+            LOG.info(f"no seinfeld index at {config.index_path}, using slow search")
+
+    async def stop(self) -> None:
+        LOG.info(
+            f"passage cache: {len(self.passages)} entries, "
+            f"{self.passages.hit_rate:.1%} hit rate"
+        )
+        await self.stack.aclose()
+
+    @command(
+        usage="[subject]",
+        limits={"user": (5, 60), "channel": (20, 60)},
+        timeout=15,
+        max_concurrency=8,
+        overflow="reject",
+        description="""post a random Seinfeld quote
+
+        subject: string - words or "quoted phrases" to search for, optionally
+        filtered with speaker:<name> or episode:<title>
+        """,
+    )
+    async def seinfeld(self, message: Message, subject: str) -> Optional[str]:
+        if self.corpus is not None:
+            if self.index:
+                quote_id = await self.index.random(subject)
+                pos = self.corpus.position(quote_id) if quote_id else None
+            else:
+                pos = self.corpus.random(subject)
+            if pos is None:
+                return None
+
+            quote_id = self.corpus.ids[pos]
+            text = self.passages.get(quote_id)
+            if text is None:
+                text = self.corpus.passage(pos)
+                self.passages.put(quote_id, text)
+            return text
+
+        if self.pool is None:
+            return "No soup for you!"
+
+        if self.index:
+            quote_id = await self.index.random(subject)
+            if quote_id is None:
+                return None
+
+            # popular passages skip the corpus database entirely
+            text = self.passages.get(quote_id)
+            if text is not None:
+                return text
+
+        async with self.pool.acquire() as seinfeld:
+            if self.index:
+                quote = await seinfeld.quote(quote_id)
+            else:
+                quote = await seinfeld.random(subject=subject)
+                if quote:
+                    text = self.passages.get(quote.id)
+                    if text is not None:
+                        return text
+
             LOG.debug(f"got quote {quote}")
             if quote:
                 passage = await seinfeld.passage(quote)
                 episode = passage.episode
-                quotes = passage.quotes
-
-                header = (
-                    f"Episode s{episode.season.number}e{episode.number} "
-                    f'"{episode.title}"'
+                text = render_passage(
+                    episode.season.number,
+                    episode.number,
+                    episode.title,
+                    ((quote.speaker.name, quote.text) for quote in passage.quotes),
                 )
-                lines = [f"{quote.speaker.name}:  {quote.text}" for quote in quotes]
-                body = "\n".join(lines)
+                self.passages.put(quote.id, text)
+                return text
 
-                return f"{header}\n{body}"
+        return None
@@ -3,25 +3,226 @@
 # Licensed under the MIT license
 
 import asyncio
+import json
 import logging
+import os
 import time
-from typing import Optional, List, Any
+from contextlib import AsyncExitStack
+from typing import Optional, List, Any, Dict, Mapping, Tuple
 
-from discord import Message
-from peony import PeonyClient
-from peony.exceptions import PeonyException
+import aiosqlite
+from discord import Guild, Message, TextChannel
+from discord.abc import GuildChannel
+from peony import BasePeonyClient
+from peony.exceptions import DuplicatedStatus, PeonyException, TweetTooLong
 
+from legion import db, metrics
 from legion.unit import Unit, command
 
 LOG = logging.getLogger(__name__)
 
+OUTBOX_LEASE = 300  # seconds a claimed outbox job is reserved for one process
+
+
+class PollSchedule:
+    """
+    Adaptive interval between timeline polls.
+
+    Polling speeds up while new tweets keep arriving and backs off while the
+    timeline is idle, but never spends the remaining rate limit budget faster
+    than it refills.
+    """
+
+    def __init__(self, minimum: float, maximum: float):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.interval = minimum
+
+    def update(self, count: int, headers: Optional[Mapping[str, str]] = None) -> float:
+        """Adjust the interval after a poll, returning seconds until the next."""
+        if count:
+            self.interval = max(self.minimum, self.interval / 2)
+        else:
+            self.interval = min(self.maximum, self.interval * 1.5)
+
+        wait = self.interval
+        if headers:
+            try:
+                remaining = int(headers["x-rate-limit-remaining"])
+                reset = float(headers["x-rate-limit-reset"])
+            except (KeyError, ValueError):
+                return wait
+
+            window = max(0.0, reset - time.time())
+            if remaining <= 0:
+                wait = max(wait, window)
+            else:
+                wait = max(wait, window / remaining)
+
+        return wait
+
+    def backoff(self) -> float:
+        """Slow down after a failed poll."""
+        self.interval = self.maximum
+        return self.interval
+
+
+class Outbox:
+    """
+    Durable queue of statuses waiting to be posted to Twitter.
+
+    Jobs stay in the database until they are posted, or until they fail
+    permanently, so nothing is lost when Twitter is down or the bot restarts.
+    Shard processes share one outbox, and claim jobs with a lease before
+    posting them, so each job is only posted once; jobs claimed by a process
+    that dies become available again when the lease expires.
+    """
+
+    def __init__(self, db: aiosqlite.Connection):
+        self.db = db
+
+    async def __aenter__(self) -> "Outbox":
+        await self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY,
+                status TEXT,
+                created_at REAL,
+                not_before REAL,
+                attempts INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                error TEXT,
+                owner TEXT,
+                lease_until REAL DEFAULT 0
+            )
+            """
+        )
+        async with self.db.execute("PRAGMA table_info(outbox)") as cursor:
+            columns = {row[1] async for row in cursor}
+        if "owner" not in columns:
+            await self.db.execute("ALTER TABLE outbox ADD COLUMN owner TEXT")
+            await self.db.execute(
+                "ALTER TABLE outbox ADD COLUMN lease_until REAL DEFAULT 0"
+            )
+        await self.db.execute(
+            """
+            CREATE INDEX IF NOT EXISTS outbox_due
+            ON outbox (failed, not_before)
+            """
+        )
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        pass
+
+    async def push(self, status: str) -> int:
+        now = time.time()
+        async with self.db.execute(
+            "INSERT INTO outbox (status, created_at, not_before) VALUES (?, ?, ?)",
+            [status, now, now],
+        ) as cursor:
+            assert cursor.lastrowid is not None
+            return cursor.lastrowid
+
+    async def claim(
+        self, owner: str, limit: int, lease: float
+    ) -> List[Tuple[int, str, int]]:
+        """Lease up to `limit` due jobs to the given owner, and return them."""
+        now = time.time()
+        claim = """
+            UPDATE outbox SET owner = ?, lease_until = ?
+            WHERE id IN (
+                SELECT id FROM outbox
+                WHERE failed = 0 AND not_before <= ? AND lease_until <= ?
+                ORDER BY id
+                LIMIT ?
+            )
+        """
+        query = """
+            SELECT id, status, attempts FROM outbox
+            WHERE owner = ? AND lease_until = ?
+            ORDER BY id
+        """
+        await self.db.execute("BEGIN IMMEDIATE")
+        try:
+            await self.db.execute(claim, [owner, now + lease, now, now, limit])
+            async with self.db.execute(query, [owner, now + lease]) as cursor:
+                jobs = [(id, status, attempts) async for id, status, attempts in cursor]
+            await self.db.execute("COMMIT")
+        except Exception:
+            await self.db.execute("ROLLBACK")
+            raise
+        return jobs
+
+    async def next_due(self) -> Optional[float]:
+        query = """
+            SELECT min(max(not_before, lease_until)) FROM outbox WHERE failed = 0
+        """
+        async with self.db.execute(query) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+    async def complete(
+        self,
+        posted: List[int],
+        retries: List[Tuple[float, int, str, int]],
+        failures: List[Tuple[int, str, int]],
+    ) -> None:
+        """Record the results of a batch of posts in a single transaction."""
+        await self.db.execute("BEGIN IMMEDIATE")
+        try:
+            await self.db.executemany(
+                "DELETE FROM outbox WHERE id = ?", [(id,) for id in posted]
+            )
+            await self.db.executemany(
+                """
+                UPDATE outbox
+                SET not_before = ?, attempts = ?, error = ?, lease_until = 0
+                WHERE id = ?
+                """,
+                retries,
+            )
+            await self.db.executemany(
+                """
+                UPDATE outbox SET failed = 1, attempts = ?, error = ?
+                WHERE id = ?
+                """,
+                failures,
+            )
+            await self.db.execute("COMMIT")
+        except Exception:
+            await self.db.execute("ROLLBACK")
+            raise
+
 
 class Twitter(Unit):
+    EAGER = True
+    EAGER_IF = (
+        "twitter.consumer_key",
+        "twitter.consumer_secret",
+        "twitter.access_key",
+        "twitter.access_secret",
+    )
+    GATEWAY = True  # announcements need the gateway's guild cache
+    INTENTS = ("guilds",)
+
     async def start(self) -> None:
         await super().start()
 
         self.config = self.bot.config.twitter
         self.task = None
+        self.worker = None
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self.owner = str(os.getpid())
+
+        self.stack = AsyncExitStack()
+        conn = await self.stack.enter_async_context(db.connect(self.config.outbox_path))
+        self.outbox: Outbox = await self.stack.enter_async_context(Outbox(conn))
+
+        self.targets: Dict[int, List[TextChannel]] = {}
+        for guild in self.client.guilds:
+            self.refresh_targets(guild)
         if not all(
             [
                 self.config.consumer_key,
@@ -34,18 +235,57 @@ class Twitter(Unit):
             return
 
         # logging.getLogger("peony").setLevel(logging.WARNING)
-        self.twitter = PeonyClient(
+        self.twitter = BasePeonyClient(
             consumer_key=self.config.consumer_key,
             consumer_secret=self.config.consumer_secret,
             access_token=self.config.access_key,
             access_token_secret=self.config.access_secret,
+            base_url=self.config.api_url or None,
         )
 
-        self.task = asyncio.ensure_future(self.timeline())
+        if self.bot.upstream is None:
+            # split mode workers only drain the outbox, the gateway polls
+            self.task = asyncio.ensure_future(self.timeline())
+        self.worker = asyncio.ensure_future(self.drain())
 
     async def stop(self) -> None:
-        if self.task:
-            self.task.cancel()
+        if self.worker:
+            if self.task:
+                self.task.cancel()
+
+            # finish posting the current batch rather than leave it leased
+            self.stopping = True
+            self.wakeup.set()
+            try:
+                await asyncio.wait_for(self.worker, self.bot.config.bot.drain_timeout)
+            except asyncio.TimeoutError:
+                LOG.warning("outbox batch unfinished at shutdown, cancelled")
+            await self.twitter.close()
+        await self.stack.aclose()
+
+    def load_cursor(self) -> Optional[str]:
+        """The last seen tweet id persisted by a previous run."""
+        key = self.bot.shard_key("since_id")
+        if key in self.state:
+            return self.state.get(key)
+
+        # move the cursor file from older versions into bot state
+        path = self.bot.shard_path(self.config.state_path)
+        try:
+            since_id = json.loads(path.read_text()).get("since_id", None)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            LOG.exception(f"failed to read twitter state {path}")
+            return None
+
+        LOG.info(f"migrating twitter cursor from {path}")
+        self.save_cursor(since_id)
+        return since_id
+
+    def save_cursor(self, since_id: Optional[str]) -> None:
+        # each shard process announces to its own guilds, so tracks its own cursor
+        self.state.set(self.bot.shard_key("since_id"), since_id)
 
     async def timeline(self) -> None:
         """Run loop, poll for updates and push new posts to slack."""
@@ -55,16 +295,21 @@ class Twitter(Unit):
             return
 
         LOG.debug("connecting to twitter API")
-        me = await self.twitter.user
+        me = await self.twitter.api.account.verify_credentials.get()
         LOG.info(f"connected to twitter as @{me.screen_name}")
 
-        since_id = None
+        since_id = self.load_cursor()
+        if since_id is not None:
+            LOG.info(f"catching up on timeline since {since_id}")
+
+        schedule = PollSchedule(self.config.poll_min, self.config.poll_max)
 
         while True:
             ts = time.time()
+            wait = schedule.interval
 
             try:
-                kwargs = {"count": 20, "include_entities": False}
+                kwargs: Dict[str, Any] = {"count": 200, "include_entities": False}
                 if since_id is None:
                     kwargs["count"] = 1
                 else:
@@ -76,41 +321,83 @@ class Twitter(Unit):
                     LOG.info(f"timeline:")
                     for tweet in reversed(tweets):
                         LOG.info(f" @{tweet.user.screen_name}: {tweet.text}")
-                    tweet = tweets[-1]
 
-                    if (
-                        since_id is not None
-                        and tweet.user.screen_name != me.screen_name
-                    ):
-                        await self.announce(tweet)
+                        if (
+                            since_id is not None
+                            and tweet.user.screen_name != me.screen_name
+                        ):
+                            await self.announce(tweet)
 
-                    since_id = tweet.id_str
+                    # timeline is newest first
+                    since_id = tweets[0].id_str
+                    self.save_cursor(since_id)
 
                 else:
                     LOG.debug(f"timeline empty")
 
+                wait = schedule.update(len(tweets), tweets.headers)
+
             except PeonyException:
                 LOG.exception("timeline update failed")
+                wait = schedule.backoff()
 
             except Exception:
                 LOG.exception(r"¯\_(ツ)_/¯")
 
             finally:
-                wait = (ts + 90) - time.time()
+                wait = (ts + wait) - time.time()
                 if wait > 0:
-                    LOG.debug(f"sleeping for {wait}s")
+                    LOG.debug(f"sleeping for {wait:.1f}s")
                     await asyncio.sleep(wait)
 
     def tweet_url(self, tweet: Any) -> str:
         return f"🐓 https://twitter.com/{tweet.user.screen_name}/status/{tweet.id_str}"
 
+    def refresh_targets(self, guild: Guild) -> None:
+        """Resolve the configured timeline channels for a single guild."""
+        names = self.config.timeline_channels.get(guild.name, [])
+        channels = [c for c in guild.text_channels if c.name in names]
+        if channels:
+            self.targets[guild.id] = channels
+        else:
+            self.targets.pop(guild.id, None)
+
+    async def on_guild_available(self, guild: Guild) -> None:
+        self.refresh_targets(guild)
+
+    async def on_guild_join(self, guild: Guild) -> None:
+        self.refresh_targets(guild)
+
+    async def on_guild_update(self, before: Guild, after: Guild) -> None:
+        self.refresh_targets(after)
+
+    async def on_guild_unavailable(self, guild: Guild) -> None:
+        self.targets.pop(guild.id, None)
+
+    async def on_guild_remove(self, guild: Guild) -> None:
+        self.targets.pop(guild.id, None)
+
+    async def on_guild_channel_create(self, channel: GuildChannel) -> None:
+        self.refresh_targets(channel.guild)
+
+    async def on_guild_channel_delete(self, channel: GuildChannel) -> None:
+        self.refresh_targets(channel.guild)
+
+    async def on_guild_channel_update(
+        self, before: GuildChannel, after: GuildChannel
+    ) -> None:
+        self.refresh_targets(after.guild)
+
     async def announce(self, tweet: Any) -> None:
         LOG.info(f"twitter announce {tweet}")
         text = self.tweet_url(tweet)
-        for guild in self.client.guilds:
-            channels = self.config.timeline_channels.get(guild.name, [])
-            for channel in (c for c in guild.channels if c.name in channels):
-                await channel.send(text)
+        channels = [c for targets in self.targets.values() for c in targets]
+        results = await asyncio.gather(
+            *(channel.send(text) for channel in channels), return_exceptions=True
+        )
+        for channel, result in zip(channels, results):
+            if isinstance(result, Exception):
+                LOG.error(f"failed to announce tweet in {channel}: {result}")
 
     async def update(self, status: str) -> Any:
         try:
@@ -121,8 +408,72 @@ class Twitter(Unit):
             LOG.exception("failed to update status")
             return None
 
-    @command(usage="<status>", description="twitter a new tweet")
-    async def tweet(self, message: Message, status: str) -> str:
+    async def enqueue(self, status: str) -> None:
+        """Record a status in the outbox, to be posted in the background."""
+        job = await self.outbox.push(status)
+        LOG.debug(f"queued outbox job {job}: {status!r}")
+        self.wakeup.set()
+
+    async def drain(self) -> None:
+        """Run loop, post due outbox jobs in batches, retrying with backoff."""
+        while not self.stopping:
+            try:
+                self.wakeup.clear()
+                jobs = await self.outbox.claim(
+                    self.owner, self.config.outbox_batch, OUTBOX_LEASE
+                )
+                if not jobs:
+                    next_due = await self.outbox.next_due()
+                    timeout = None if next_due is None else next_due - time.time()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                posted: List[int] = []
+                retries: List[Tuple[float, int, str, int]] = []
+                failures: List[Tuple[int, str, int]] = []
+
+                for job, status, attempts in jobs:
+                    attempts += 1
+                    try:
+                        await self.twitter.api.statuses.update.post(status=status)
+                        posted.append(job)
+                        metrics.incr("twitter.outbox.posted")
+
+                    except (DuplicatedStatus, TweetTooLong) as e:
+                        LOG.error(f"outbox job {job} rejected: {e}")
+                        failures.append((attempts, str(e), job))
+                        metrics.incr("twitter.outbox.failed")
+
+                    except Exception as e:
+                        if attempts >= self.config.outbox_attempts:
+                            LOG.error(f"outbox job {job} failed {attempts} times: {e}")
+                            failures.append((attempts, str(e), job))
+                            metrics.incr("twitter.outbox.failed")
+                        else:
+                            delay = self.config.outbox_backoff * 2 ** (attempts - 1)
+                            LOG.warning(f"outbox job {job} retry in {delay}s: {e}")
+                            retries.append((time.time() + delay, attempts, str(e), job))
+                            metrics.incr("twitter.outbox.retried")
+
+                await self.outbox.complete(posted, retries, failures)
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                LOG.exception("outbox drain failed")
+                await asyncio.sleep(self.config.outbox_backoff)
+
+    @command(
+        usage="<status>",
+        description="twitter a new tweet",
+        limits={"user": (2, 300), "guild": (10, 3600)},
+    )
+    async def tweet(self, message: Message, status: str) -> Optional[str]:
         tweet = await self.update(status)
         if tweet is not None:
             return self.tweet_url(tweet)
+        return None
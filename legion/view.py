@@ -0,0 +1,62 @@
+# Copyright 2020 John Reese
+# Licensed under the MIT license
+
+from typing import Any, Optional, Tuple
+
+from discord import DMChannel, Message
+
+# mention, command name, and arguments, as matched by legion.matcher
+CommandMatch = Tuple[Optional[str], str, Optional[str]]
+
+
+class MessageView:
+    """
+    An incoming message, with per-message normalization done once.
+
+    The bot builds one view per message and passes it to command handlers and
+    units in place of the message itself. Any other attribute falls through
+    to the wrapped discord message, so the view can be used just like one.
+    """
+
+    __slots__ = (
+        "message",
+        "clean_content",
+        "command",
+        "direct",
+        "server_name",
+        "channel_name",
+        "_casefold",
+    )
+
+    def __init__(
+        self,
+        message: Message,
+        clean_content: Optional[str] = None,
+        command: Optional[CommandMatch] = None,
+    ):
+        self.message = message
+        self.clean_content: str = (
+            message.clean_content if clean_content is None else clean_content
+        )
+        self.command = command
+        self.direct = isinstance(message.channel, DMChannel)
+        if self.direct:
+            self.server_name = "dm"
+            self.channel_name = message.author.display_name
+        else:
+            self.server_name = message.guild.name if message.guild else ""
+            self.channel_name = getattr(message.channel, "name", "")
+        self._casefold: Optional[str] = None
+
+    @property
+    def casefold(self) -> str:
+        """Clean content, casefolded for case insensitive comparisons."""
+        if self._casefold is None:
+            self._casefold = self.clean_content.casefold()
+        return self._casefold
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.message, name)
+
+    def __repr__(self) -> str:
+        return f"<MessageView {self.message!r}>"